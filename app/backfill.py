@@ -0,0 +1,64 @@
+import time
+import asyncio
+from os import getenv
+from collections import OrderedDict, deque
+
+# The most backfills that can read from the database at once
+concurrency = int(getenv('BACKFILL_CONCURRENCY', 16))
+
+class Backfill:
+    # The state of sending existing results for a subscription
+
+    def __init__(self, socket, contexts):
+        self.socket = socket
+        self.contexts = set(contexts)
+        self.held = {} # key -> (cluster time, frame, outbox key)
+        self.time = None # snapshot cluster time
+        self.done = False
+        self.task = None
+        self.created = time.perf_counter()
+
+class Scheduler:
+    # Runs backfills within a global concurrency budget,
+    # taking turns between sockets so that one socket
+    # subscribing to many contexts can't starve the rest
+
+    def __init__(self, concurrency=concurrency):
+        self.concurrency = concurrency
+        self.running = set()
+        self.waiting = OrderedDict() # socket -> deque((backfill, run))
+
+    def submit(self, backfill, run):
+        self.waiting.setdefault(backfill.socket, deque()).append((backfill, run))
+        self.start()
+
+    def start(self):
+        while len(self.running) < self.concurrency and self.waiting:
+            # Take the first socket in line and send
+            # it to the back if it has more waiting
+            socket, queue = self.waiting.popitem(last=False)
+            backfill, run = queue.popleft()
+            if queue:
+                self.waiting[socket] = queue
+
+            self.running.add(backfill)
+            backfill.task = asyncio.create_task(run())
+            backfill.task.add_done_callback(lambda task, backfill=backfill: self.finished(backfill))
+
+    def finished(self, backfill):
+        self.running.discard(backfill)
+        self.start()
+
+    def cancel(self, backfill):
+        if backfill.task:
+            backfill.task.cancel()
+            return
+
+        queue = self.waiting.get(backfill.socket)
+        if not queue: return
+        for item in queue:
+            if item[0] is backfill:
+                queue.remove(item)
+                break
+        if not queue:
+            del self.waiting[backfill.socket]
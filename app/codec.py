@@ -0,0 +1,28 @@
+import json
+from os import getenv
+
+# JSON encoding for everything sent over the websocket.
+# Set JSON_CODEC to choose the implementation, falling
+# back to the standard library if it isn't installed.
+
+def orjson_codec():
+    import orjson
+    return (lambda obj: orjson.dumps(obj).decode()), orjson.loads
+
+def ujson_codec():
+    import ujson
+    return (lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)), ujson.loads
+
+def json_codec():
+    return (lambda obj: json.dumps(obj, separators=(',', ':'), ensure_ascii=False)), json.loads
+
+codecs = {
+    'orjson': orjson_codec,
+    'ujson': ujson_codec,
+    'json': json_codec
+}
+
+try:
+    dumps, loads = codecs[getenv('JSON_CODEC', 'orjson')]()
+except ImportError:
+    dumps, loads = json_codec()
@@ -0,0 +1,25 @@
+from os import getenv
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+# Websocket compression. Each socket keeps a compressor
+# of about 2**(window_bits+2) + 2**(mem_level+9) bytes
+# unless no_context_takeover is set, which trades
+# compression for memory on deployments with many sockets.
+enabled = getenv('WS_DEFLATE', 'true') == 'true'
+level = int(getenv('WS_DEFLATE_LEVEL', 6))
+mem_level = int(getenv('WS_DEFLATE_MEM_LEVEL', 5))
+window_bits = int(getenv('WS_DEFLATE_WINDOW_BITS', 15))
+no_context_takeover = getenv('WS_DEFLATE_NO_CONTEXT_TAKEOVER', 'false') == 'true'
+
+class Protocol(WebSocketProtocol):
+    # Uvicorn's websocket protocol with
+    # the compression settings above
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = [ ServerPerMessageDeflateFactory(
+            server_no_context_takeover=no_context_takeover,
+            server_max_window_bits=window_bits if window_bits < 15 else None,
+            compress_settings={ "level": level, "memLevel": mem_level })
+        ] if enabled else []
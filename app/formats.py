@@ -0,0 +1,103 @@
+import math
+from .codec import dumps, loads
+
+# Encodings a client can choose between by asking for
+# them as a websocket subprotocol. JSON text is used
+# when it doesn't ask for one. Binary formats are left
+# out if their library isn't installed.
+
+class Format:
+
+    def __init__(self, name, binary, dumps, loads, batch_frame):
+        self.name = name
+        self.binary = binary
+        self.dumps = dumps
+        self.loads = loads
+        # Joins objects that were encoded separately
+        # into a frame of historical results
+        self.batch_frame = batch_frame
+
+    def sender(self, socket):
+        return socket.send_bytes if self.binary else socket.send_text
+
+    def receiver(self, socket):
+        return socket.receive_bytes if self.binary else socket.receive_text
+
+def json_format():
+    def batch_frame(objs, msg, seq):
+        frame = '{"' + msg + 's":[' + ','.join(objs) + '],"historical":true'
+        if seq: frame += ',"seq":' + str(seq)
+        return frame + '}'
+    return Format('graffiti.json', False, dumps, loads, batch_frame)
+
+def msgpack_format():
+    import msgpack
+    packb = msgpack.packb
+    headers = msgpack.Packer()
+    def batch_frame(objs, msg, seq):
+        frame = headers.pack_map_header(3 if seq else 2) \
+            + packb(msg + 's') + headers.pack_array_header(len(objs)) + b''.join(objs) \
+            + packb('historical') + packb(True)
+        if seq: frame += packb('seq') + packb(seq)
+        return frame
+    def ext_hook(code, data):
+        raise Exception(f"extension type {code} is not a JSON value")
+    def unpackb(data):
+        return json_value(msgpack.unpackb(data, raw=False, ext_hook=ext_hook))
+    return Format('graffiti.msgpack', True, packb, unpackb, batch_frame)
+
+def cbor_format():
+    import cbor2
+    cbor = cbor2.dumps
+    def batch_frame(objs, msg, seq):
+        # The objects go in an indefinite length array
+        frame = bytes([0xa0 | (3 if seq else 2)]) \
+            + cbor(msg + 's') + b'\x9f' + b''.join(objs) + b'\xff' \
+            + cbor('historical') + cbor(True)
+        if seq: frame += cbor('seq') + cbor(seq)
+        return frame
+    def tag_hook(decoder, tag):
+        raise Exception(f"tag {tag.tag} is not a JSON value")
+    def loads(data):
+        return json_value(cbor2.loads(data, tag_hook=tag_hook))
+    return Format('graffiti.cbor', True, cbor, loads, batch_frame)
+
+def json_value(value):
+    # Binary formats can carry values that JSON can't,
+    # like bytes, dates and sets, which the library
+    # decodes on its own. They couldn't be stored or
+    # sent to JSON clients, so they are rejected.
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise Exception(f"{type(key).__name__} keys are not allowed in JSON")
+            json_value(item)
+    elif isinstance(value, list):
+        for item in value:
+            json_value(item)
+    elif isinstance(value, float):
+        if not math.isfinite(value):
+            raise Exception(f"{value} is not a JSON value")
+    elif isinstance(value, int):
+        if not -2**63 <= value < 2**64:
+            raise Exception("integers must fit in 64 bits")
+    elif value is not None and not isinstance(value, str):
+        raise Exception(f"{type(value).__name__} is not a JSON value")
+    return value
+
+default = json_format()
+formats = { default.name: default }
+for create in [msgpack_format, cbor_format]:
+    try:
+        format = create()
+    except ImportError:
+        continue
+    formats[format.name] = format
+
+def negotiate(subprotocols):
+    # The first format the client asks for that is
+    # available, and the subprotocol to accept
+    for name in subprotocols:
+        if name in formats:
+            return formats[name], name
+    return default, None
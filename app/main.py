@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 import jwt
+import time
+import asyncio
+import logging
 import uvicorn
 from os import getenv
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 
-from . import rest
+from . import rest, metrics, tracing, profiler
 from .schema import validate
+from .formats import negotiate
+from .deflate import Protocol
 from .pubsub import PubSub
+from .pipeline import Pipeline
+from .storage import create_storage
 
 app = FastAPI()
 
@@ -24,29 +30,45 @@ app.add_middleware(
 # Token authorization (generated by auth container)
 secret = getenv('AUTH_SECRET')
 
+# With multiple worker processes, one of them watches
+# the database and relays changes over a Unix socket
+workers = int(getenv('WORKERS', 1))
+relay_path = getenv('RELAY_PATH', '/tmp/graffiti-relay.sock')
+
+logger = logging.getLogger('uvicorn.error')
+
 @app.on_event("startup")
 async def startup():
-    # Initialize the database
-    client = AsyncIOMotorClient('mongo')
-    if 'objects' not in await client.graffiti.list_collection_names():
-        await client.graffiti.create_collection('objects', changeStreamPreAndPostImages={'enabled': True})
+    # Initialize the database and bring
+    # existing data up to date
+    app.db = create_storage()
+    await app.db.setup()
+    app.purge_task = asyncio.create_task(purge())
 
-    app.db = client.graffiti.objects
+    # Keep track of the total set of contexts that people are subscribed to
+    # and route database changes to them
+    app.pubsub = PubSub(app.db, relay_path if workers > 1 else None)
 
-    # Create indexes if they don't already exist
-    await app.db.create_index('id', unique=True)
-    await app.db.create_index('actor')
-    await app.db.create_index('context')
-    await app.db.create_index('bto')
-    await app.db.create_index('bcc')
+    if metrics.port:
+        metrics.start(app.pubsub, workers)
 
-    # Keep track of the total set of contexts that people are subscribed to
-    # When that set changes, update the pipeline
-    app.pubsub = PubSub(app.db)
+    # Profile the event loop when asked to
+    profiler.install()
+
+async def purge():
+    # Periodically forget expired tombstones
+    while True:
+        try:
+            await rest.purge(app.db)
+        except Exception:
+            logger.exception("could not purge tombstones")
+        await asyncio.sleep(60*60)
 
 @app.websocket("/")
 async def query_socket(socket: WebSocket, token: str|None=None):
-    await socket.accept()
+    # Speak whichever encoding the client asks for
+    socket.format, subprotocol = negotiate(socket.scope.get('subprotocols', []))
+    await socket.accept(subprotocol=subprotocol)
     # Perform authorization
     socket.actor = None
     if token:
@@ -55,37 +77,75 @@ async def query_socket(socket: WebSocket, token: str|None=None):
             assert token["type"] == "token"
             socket.actor = token["actor"]
         except:
-            await socket.send_json({
+            await socket.format.sender(socket)(socket.format.dumps({
                 'error': 'authorization',
                 'detail': 'invalid token'
-            })
+            }))
 
     # Register with the pub/sub manager
     async with app.pubsub.register(socket):
 
-        # Send messages back and forth
-        while True:
-            try:
-                msg = await socket.receive_json()
-                await reply(socket, msg)
-            except:
-                break
-
-async def reply(socket, msg):
-    # Initialize the output
+        # Send messages back and forth, handling
+        # several requests at once
+        pipeline = Pipeline(lambda msg, received: respond(socket, msg, received))
+        receive = socket.format.receiver(socket)
+        try:
+            while True:
+                try:
+                    data = await receive()
+                    received = time.perf_counter()
+                except:
+                    break
+
+                # A frame that can't be decoded has
+                # no messageID to reply to
+                try:
+                    msg = socket.format.loads(data)
+                except Exception as e:
+                    await socket.outbox.send(socket.format.dumps({
+                        'error': 'validation',
+                        'detail': str(e).split('\n')[0]
+                    }))
+                    continue
+                await pipeline.submit(msg, received)
+        finally:
+            await pipeline.close()
+
+async def respond(socket, msg, received=None):
+    # A request that fails without a reply would
+    # leave the client waiting, so hang up instead
+    try:
+        await reply(socket, msg, received)
+    except Exception:
+        logger.exception("could not reply to a request")
+        socket.outbox.evict('internal', 'the server failed to reply to a request')
+
+async def reply(socket, msg, received=None):
+    # Initialize the output. Messages that aren't
+    # objects are left for validation to reject.
     output = {}
-    if 'messageID' in msg:
+    if isinstance(msg, dict) and 'messageID' in msg:
         output['messageID'] = msg['messageID']
 
+    # Time spent waiting behind earlier requests
+    # counts towards the trace
+    operation = 'invalid'
+    if isinstance(msg, dict):
+        operation = next((op for op in operations if op in msg), 'invalid')
+    trace = tracing.begin(operation, received)
+
     # Make sure the message is formatted properly
     try:
-        validate(msg)
+        with metrics.validation.time(), tracing.span('validate'):
+            validate(msg)
     except Exception as e:
         output['error'] = 'validation'
         output['detail'] = str(e).split('\n')[0]
-        return await socket.send_json(output)
+        await socket.outbox.send(socket.format.dumps(output))
+        return tracing.end(trace)
 
     # Pass it to the proper function
+    start = time.perf_counter()
     try:
 
         if 'update' in msg:
@@ -94,8 +154,15 @@ async def reply(socket, msg):
         elif 'remove' in msg:
             reply = await rest.remove(app.db, msg['remove'], socket.actor)
 
+        elif 'updateMany' in msg:
+            reply = await rest.update_many(app.db, msg['updateMany'], socket.actor)
+
+        elif 'removeMany' in msg:
+            reply = await rest.remove_many(app.db, msg['removeMany'], socket.actor)
+
         elif 'subscribe' in msg:
-            reply = await app.pubsub.subscribe(msg['subscribe'], socket)
+            reply = await app.pubsub.subscribe(msg['subscribe'], socket,
+                    msg.get('batch', False), msg.get('since'), msg.get('patch', False))
 
         elif 'unsubscribe' in msg:
             reply = await app.pubsub.unsubscribe(msg['unsubscribe'], socket)
@@ -113,10 +180,18 @@ async def reply(socket, msg):
         output['detail'] = str(e)
 
     finally:
-        await socket.send_json(output)
+        metrics.requests.labels(operation).observe(time.perf_counter() - start)
+        with tracing.span('reply'):
+            await socket.outbox.send(socket.format.dumps(output))
+        tracing.end(trace)
+
+# Operations in the order they're checked
+operations = ['update', 'remove', 'updateMany', 'removeMany', 'subscribe', 'unsubscribe', 'get', 'ls']
 
 if __name__ == "__main__":
     args = {}
     if getenv('DEBUG') == 'true':
         args['reload'] = True
-    uvicorn.run('app.main:app', host='0.0.0.0', **args)
+    else:
+        args['workers'] = workers
+    uvicorn.run('app.main:app', host='0.0.0.0', ws=Protocol, **args)
@@ -0,0 +1,48 @@
+from os import getenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Metrics are served in the Prometheus text format on
+# a separate port, only if one is given. Each worker
+# process serves its own, on the next free port.
+port = getenv('METRICS_PORT')
+
+# Most requests take milliseconds, backfills can take much longer
+latency_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+fanout_buckets = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+requests = Histogram('graffiti_request_seconds',
+    'Time to handle a request', ['operation'], buckets=latency_buckets)
+validation = Histogram('graffiti_validation_seconds',
+    'Time to validate a request', buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005))
+changes = Counter('graffiti_changes',
+    'Changes received from the change feed')
+transaction_retries = Counter('graffiti_transaction_retries',
+    'Write transactions retried after conflicting with another')
+feed_restarts = Counter('graffiti_change_feed_restarts',
+    'Times the change feed failed and was reopened')
+fanout = Histogram('graffiti_change_fanout_sockets',
+    'Sockets a change is sent to', buckets=fanout_buckets)
+backfill_objects = Counter('graffiti_backfill_objects',
+    'Existing objects sent to new subscriptions')
+backfills = Gauge('graffiti_backfills',
+    'Backfills of new subscriptions', ['state'])
+sockets = Gauge('graffiti_sockets',
+    'Connected websockets')
+contexts = Gauge('graffiti_subscribed_contexts',
+    'Contexts with at least one subscriber')
+socket_send = Histogram('graffiti_socket_send_seconds',
+    'Time to write a frame to a websocket', buckets=latency_buckets)
+
+def start(pubsub, workers=1):
+    # Gauges that are cheaper to read when scraped
+    scheduler = pubsub.scheduler
+    backfills.labels('running').set_function(lambda: len(scheduler.running))
+    backfills.labels('waiting').set_function(lambda: sum(len(q) for q in scheduler.waiting.values()))
+    contexts.set_function(lambda: len(pubsub.context_to_sockets))
+
+    for offset in range(workers):
+        try:
+            start_http_server(int(port) + offset)
+            return
+        except OSError:
+            continue
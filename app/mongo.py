@@ -0,0 +1,494 @@
+import time
+import random
+import asyncio
+import logging
+from os import getenv
+from socket import gethostname
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+from . import metrics, tracing
+from .rest import tombstone_retention, hidden_fields, missing_error, \
+    content_hash, access_fields, access_pairs, lost_access, context_changes
+
+# The change stream's position is saved every
+# resume_token_interval seconds under watcher_id
+# and it is reopened with exponential backoff
+watcher_id = getenv('WATCHER_ID', gethostname())
+resume_token_interval = float(getenv('RESUME_TOKEN_INTERVAL', 1)) # sec
+min_backoff = 0.01 # sec
+max_backoff = 10 # sec
+
+# Transactions that conflict are retried this
+# many times, backing off with jitter
+transaction_attempts = int(getenv('TRANSACTION_ATTEMPTS', 10))
+
+# Historical objects are fetched in batches of this many
+cursor_batch_size = int(getenv('HISTORY_CURSOR_BATCH_SIZE', 1000))
+
+# The only fields of a replaced or removed object that
+# are needed: its contexts and audience for tombstones
+# and context counts
+write_projection = { "_id": 0, "context": 1, "bto": 1, "bcc": 1 }
+
+# Fields maintained by the server that clients don't see
+hidden_projection = { field: 0 for field in hidden_fields }
+
+logger = logging.getLogger('uvicorn.error')
+
+class MongoStorage:
+    # Objects live in a MongoDB replica set, changes
+    # come from a change stream on the objects collection
+
+    def __init__(self):
+        self.client = AsyncIOMotorClient('mongo')
+        self.database = self.client.graffiti
+        self.objects = self.database.objects
+        self.resume_token = None
+        self.lag = 0
+
+    async def setup(self):
+        collections = await self.database.list_collection_names()
+        if 'objects' not in collections:
+            await self.database.create_collection('objects', changeStreamPreAndPostImages={'enabled': True})
+        # Transactions write to the counters, which
+        # have to exist before they can
+        if 'counters' not in collections:
+            await self.database.create_collection('counters')
+        await self.database.counters.update_one({ "_id": "seq" },
+            { "$setOnInsert": { "value": 0 } }, upsert=True)
+
+        # Create indexes if they don't already exist
+        await self.objects.create_index('id', unique=True)
+        await self.objects.create_index('actor')
+        await self.objects.create_index('_seq')
+
+        # Removed objects leave tombstones behind
+        # for incremental subscriptions
+        await self.database.tombstones.create_index('_seq')
+        await self.database.tombstones.create_index('_removed')
+
+        # Queries with "since" are bounded on both fields,
+        # the rest use the index as one on _access alone
+        for collection in [self.objects, self.database.tombstones]:
+            await collection.create_index([('_access', 1), ('_seq', 1)])
+            if '_access_1' in await collection.index_information():
+                await collection.drop_index('_access_1')
+
+        # The contexts each actor has objects in
+        await self.database.contexts.create_index([('actor', 1), ('context', 1)], unique=True)
+
+        # Bring existing data up to date
+        await self.migrate()
+
+    async def update(self, object, actor):
+        # An identical copy is left alone without writing
+        # anything, otherwise the object is inserted or replaced
+        tracing.query('object', lambda: explain(self.objects.find({ "id": object["id"] })))
+        object_hash = content_hash(object)
+
+        # Checked outside of a transaction,
+        # so an unchanged copy costs one read
+        old_object = await self.objects.find_one({ "id": object["id"] }, { "_id": 0, "_hash": 1 })
+        if old_object and old_object.get("_hash") == object_hash:
+            return "replaced"
+
+        async def write(session):
+            old_object = await self.objects.find_one({ "id": object["id"] },
+                write_projection | { "_hash": 1 }, session=session)
+            if old_object and old_object.get("_hash") == object_hash:
+                return "replaced"
+
+            seq = await self.sequence(1, session)
+            fields = { "_seq": seq, "_hash": object_hash } | access_fields(object)
+            await self.objects.replace_one({ "id": object["id"] }, object | fields,
+                upsert=True, session=session)
+
+            if old_object:
+                old_object |= { "id": object["id"], "actor": actor }
+                # If anyone might have lost sight of the object,
+                # leave a tombstone for incremental subscribers
+                if lost_access(old_object, object):
+                    await self.tombstone(old_object, seq, session)
+                await self.count_contexts(actor, context_changes(object["context"], old_object["context"]), session)
+            else:
+                await self.count_contexts(actor, context_changes(object["context"], []), session)
+
+            await self.claim(1, session)
+            return "replaced" if old_object else "inserted"
+
+        return await self.transaction(write)
+
+    async def update_many(self, objects, actor):
+        # The objects being replaced are read and written
+        # in one transaction, so the old versions are
+        # exactly the ones the writes replace
+        query = { "id": { "$in": [ object["id"] for object in objects ] } }
+        tracing.query('objects', lambda: explain(self.objects.find(query)))
+
+        async def write(session):
+            results = [ None ] * len(objects)
+            old_objects = { doc["id"]: doc async for doc in self.objects.find(query,
+                write_projection | { "id": 1, "_hash": 1 }, session=session) }
+
+            # Leave out objects that are unchanged
+            writes = []
+            for i, object in enumerate(objects):
+                object_hash = content_hash(object)
+                old_object = old_objects.get(object["id"])
+                if old_object and old_object.get("_hash") == object_hash:
+                    results[i] = { "reply": "replaced" }
+                else:
+                    writes.append((i, object_hash, old_object))
+            if not writes: return results
+
+            last_seq = await self.sequence(len(writes), session)
+            ops, tombstones, changes = [], [], Counter()
+            for seq, (i, object_hash, old_object) in zip(range(last_seq - len(writes) + 1, last_seq + 1), writes):
+                object = objects[i]
+                fields = { "_seq": seq, "_hash": object_hash } | access_fields(object)
+                ops.append(ReplaceOne({ "id": object["id"] }, object | fields, upsert=True))
+
+                if old_object:
+                    results[i] = { "reply": "replaced" }
+                    old_object = old_object | { "actor": actor }
+                    # If anyone might have lost sight of the object,
+                    # leave a tombstone for incremental subscribers
+                    if lost_access(old_object, object):
+                        tombstones.append(tombstone_document(old_object, seq))
+                    context_changes(object["context"], old_object["context"], changes)
+                else:
+                    results[i] = { "reply": "inserted" }
+                    context_changes(object["context"], [], changes)
+
+            await self.objects.bulk_write(ops, ordered=False, session=session)
+            if tombstones:
+                await self.database.tombstones.insert_many(tombstones, ordered=False, session=session)
+            await self.count_contexts(actor, changes, session)
+            await self.claim(len(writes), session)
+            return results
+
+        return await self.transaction(write)
+
+    async def remove(self, object_id, actor):
+        tracing.query('object', lambda: explain(self.objects.find({ "id": object_id })))
+
+        async def write(session):
+            old_object = await self.objects.find_one_and_delete({
+                "id": object_id,
+            }, projection=write_projection, session=session)
+            if not old_object: return None
+
+            seq = await self.sequence(1, session)
+            old_object |= { "id": object_id, "actor": actor }
+            await self.tombstone(old_object, seq, session)
+            await self.count_contexts(actor, context_changes([], old_object["context"]), session)
+            await self.claim(1, session)
+            return "removed"
+
+        reply = await self.transaction(write)
+        if not reply:
+            raise Exception(missing_error)
+        return reply
+
+    async def remove_many(self, object_ids, actor):
+        # The objects are read and removed in one transaction,
+        # so every object read is one that gets removed
+        query = { "id": { "$in": object_ids } }
+        tracing.query('objects', lambda: explain(self.objects.find(query)))
+
+        async def write(session):
+            results = [ { "error": missing_error } for object_id in object_ids ]
+            indices = { object_id: i for i, object_id in enumerate(object_ids) }
+            old_objects = [ doc async for doc in self.objects.find(query,
+                write_projection | { "id": 1 }, session=session) ]
+            if not old_objects: return results
+
+            last_seq = await self.sequence(len(old_objects), session)
+            await self.objects.bulk_write([
+                DeleteOne({ "id": old_object["id"] }) for old_object in old_objects
+            ], ordered=False, session=session)
+
+            tombstones, changes = [], Counter()
+            for seq, old_object in zip(range(last_seq - len(old_objects) + 1, last_seq + 1), old_objects):
+                results[indices[old_object["id"]]] = { "reply": "removed" }
+                tombstones.append(tombstone_document(old_object | { "actor": actor }, seq))
+                context_changes([], old_object["context"], changes)
+
+            await self.database.tombstones.insert_many(tombstones, ordered=False, session=session)
+            await self.count_contexts(actor, changes, session)
+            await self.claim(len(old_objects), session)
+            return results
+
+        return await self.transaction(write)
+
+    async def transaction(self, write):
+        # Run write(session) in a transaction, retrying
+        # it if it conflicts with another. Writes take
+        # their sequence values in the same transaction,
+        # and transactions that take values conflict on
+        # the counter, so values are committed in order and
+        # a client never sees one before an earlier one.
+        # Retries back off with jitter so that writers
+        # that conflicted don't all come back at once.
+        async with await self.client.start_session() as session:
+            for attempt in range(transaction_attempts):
+                try:
+                    async with session.start_transaction():
+                        return await write(session)
+                except PyMongoError as e:
+                    if not e.has_error_label("TransientTransactionError") \
+                            or attempt == transaction_attempts - 1:
+                        raise
+                metrics.transaction_retries.inc()
+                await asyncio.sleep(random.uniform(0, min(max_backoff, min_backoff * 2**attempt)))
+
+    async def contexts(self, actor):
+        tracing.query('contexts', lambda: explain(self.database.contexts.find({ "actor": actor })))
+        return [ doc["context"] async for doc in self.database.contexts.find(
+            { "actor": actor },
+            { "_id": 0, "context": 1 }) ]
+
+    async def count_contexts(self, actor, changes, session=None):
+        # Keep track of how many objects each
+        # actor has in each of their contexts
+        changes = { context: n for context, n in changes.items() if n }
+        if not changes: return
+
+        await self.database.contexts.bulk_write([
+            UpdateOne(
+                { "actor": actor, "context": context },
+                { "$inc": { "count": n } },
+                upsert=True)
+            for context, n in changes.items()
+        ], ordered=False, session=session)
+
+        decreased = [ context for context, n in changes.items() if n < 0 ]
+        if decreased:
+            await self.database.contexts.delete_many({
+                "actor": actor,
+                "context": { "$in": decreased },
+                "count": { "$lte": 0 }
+            }, session=session)
+
+    async def sequence(self, n, session):
+        # The last of the next n sequence values that
+        # writes are stamped with. Reading the counter
+        # doesn't lock it, claim() does at the end.
+        counter = await self.database.counters.find_one({ "_id": "seq" }, session=session)
+        return counter["value"] + n
+
+    async def claim(self, n, session):
+        # The last write of a transaction, so the counter
+        # is only held until the commit. If another
+        # transaction has taken values since they were
+        # read, this conflicts and the write is retried.
+        await self.database.counters.update_one({ "_id": "seq" },
+            { "$inc": { "value": n } }, session=session)
+
+    async def sequence_value(self, name="seq"):
+        counter = await self.database.counters.find_one({ "_id": name })
+        return counter["value"] if counter else 0
+
+    async def tombstone(self, old_object, seq, session=None):
+        await self.database.tombstones.insert_one(tombstone_document(old_object, seq), session=session)
+
+    async def purge(self):
+        # Forget tombstones that are older than the retention
+        # window and raise the horizon past them, so that
+        # "since" values from before it are rejected
+        expired = datetime.now(timezone.utc) - timedelta(seconds=tombstone_retention)
+        async for doc in self.database.tombstones.aggregate([
+            { "$match": { "_removed": { "$lt": expired } } },
+            { "$group": { "_id": None, "seq": { "$max": "$_seq" } } }]):
+
+            await self.database.counters.update_one(
+                { "_id": "horizon" },
+                { "$max": { "value": doc["seq"] } },
+                upsert=True)
+            await self.database.tombstones.delete_many({
+                "_seq": { "$lte": doc["seq"] }
+            })
+
+    async def migrate(self):
+        # Count the contexts of existing objects
+        if not await self.database.contexts.estimated_document_count():
+            await self.objects.aggregate([
+                { "$unwind": "$context" },
+                { "$group": {
+                    "_id": { "actor": "$actor", "context": "$context" },
+                    "count": { "$sum": 1 }
+                }},
+                { "$project": {
+                    "_id": 0,
+                    "actor": "$_id.actor",
+                    "context": "$_id.context",
+                    "count": 1
+                }},
+                { "$merge": {
+                    "into": "contexts",
+                    "on": ["actor", "context"],
+                    "whenMatched": "replace"
+                }}]).to_list(None)
+
+        # Fill in the access fields of objects
+        # and tombstones that predate them
+        for collection in [self.objects, self.database.tombstones]:
+            await collection.update_many({ "_keys": { "$exists": False } }, [
+                { "$set": { "_keys": { "$concatArrays": ["$context", ["$id"]] } } },
+                { "$set": { "_access": { "$reduce": {
+                    # Everyone who can read the object
+                    "input": { "$cond": [
+                        { "$and": [
+                            { "$eq": [{ "$type": "$bto" }, "missing"] },
+                            { "$eq": [{ "$type": "$bcc" }, "missing"] }]},
+                        ["public"],
+                        { "$setUnion": [
+                            ["$actor"],
+                            { "$ifNull": ["$bto", []] },
+                            { "$ifNull": ["$bcc", []] }]}
+                    ]},
+                    "initialValue": [],
+                    "in": { "$concatArrays": ["$$value", { "$map": {
+                        "input": "$_keys",
+                        "as": "key",
+                        "in": { "$concat": ["$$this", " ", "$$key"] }
+                    }}]}
+                }}}}
+            ])
+
+    async def changes(self):
+        # Pick up where the last watcher on this host left off
+        if self.resume_token is None:
+            self.resume_token = await self.load_resume_token()
+
+        # If the stream fails, reopen it from the last
+        # resume token, backing off while it keeps failing
+        delay = min_backoff
+        recovering = False
+        saved = time.monotonic()
+        while True:
+            try:
+                async with self.objects.watch(
+                        # Only whole-document changes are relevant, contexts
+                        # are matched when the change is routed to sockets
+                        [ { '$match' : {
+                            'operationType': { "$in": ["insert", "replace", "delete"] }
+                        }}],
+                        full_document='whenAvailable',
+                        full_document_before_change='whenAvailable',
+                        resume_after=self.resume_token) as stream:
+
+                    async for change in stream:
+                        yield change
+                        self.resume_token = stream.resume_token
+                        self.lag = time.time() - change['clusterTime'].time
+
+                        if recovering:
+                            logger.info(f"change stream recovered, {self.lag:.3f}s behind")
+                            recovering = False
+                            delay = min_backoff
+                        if time.monotonic() - saved > resume_token_interval:
+                            saved = time.monotonic()
+                            await self.save_resume_token()
+
+            except PyMongoError as e:
+                metrics.feed_restarts.inc()
+                if isinstance(e, OperationFailure) and e.code in [280, 286]:
+                    # The resume token has fallen out of the oplog,
+                    # so changes since then can't be recovered
+                    logger.error(f"change stream history lost, restarting from now: {e}")
+                    self.resume_token = None
+                else:
+                    logger.warning(f"change stream failed, retrying in {delay}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(2*delay, max_backoff)
+
+            recovering = True
+
+    async def load_resume_token(self):
+        try:
+            watcher = await self.database.watchers.find_one({ "_id": watcher_id })
+        except PyMongoError:
+            return None
+        return watcher["resume_token"] if watcher else None
+
+    async def save_resume_token(self):
+        try:
+            await self.database.watchers.replace_one({ "_id": watcher_id }, {
+                "resume_token": self.resume_token,
+                "lag": self.lag,
+                "saved": datetime.now(timezone.utc)
+            }, upsert=True)
+        except PyMongoError as e:
+            logger.warning(f"could not save the resume token: {e}")
+
+    @asynccontextmanager
+    async def snapshot(self):
+        # Reads from a snapshot line up exactly with the
+        # change stream at the snapshot's cluster time
+        async with await self.client.start_session(snapshot=True) as session:
+            snapshot = MongoSnapshot(self, session)
+            yield snapshot
+            snapshot.time = session.operation_time
+
+class MongoSnapshot:
+
+    def __init__(self, storage, session):
+        self.storage = storage
+        self.session = session
+        self.time = None
+
+    async def sequence_value(self):
+        # The last sequence value written as of the snapshot
+        counter = await self.storage.database.counters.find_one({ "_id": "seq" }, session=self.session)
+        return counter["value"] if counter else 0
+
+    def objects(self, actor, contexts, since=None):
+        query = access_query(actor, contexts, since)
+        tracing.query('objects', lambda: explain(self.storage.objects.find(query)))
+        return self.storage.objects.find(query,
+            hidden_projection,
+            batch_size=cursor_batch_size,
+            session=self.session)
+
+    def tombstones(self, actor, contexts, since):
+        query = access_query(actor, contexts, since)
+        tracing.query('tombstones', lambda: explain(self.storage.database.tombstones.find(query)))
+        return self.storage.database.tombstones.find(query,
+            { "_id": 0, "id": 1, "actor": 1, "context": 1, "_seq": 1 },
+            batch_size=cursor_batch_size,
+            session=self.session)
+
+def access_query(actor, contexts, since=None):
+    query = { "_access": { "$in": access_pairs(actor, contexts) } }
+    if since:
+        query["_seq"] = { "$gt": since }
+    return query
+
+async def explain(cursor):
+    # The stages of the winning plan, innermost
+    # last, and how much work it took
+    plan = await cursor.explain()
+    stage = plan["queryPlanner"]["winningPlan"]
+    stage = stage.get("queryPlan", stage)
+    stages = []
+    while stage:
+        stages.append(stage["stage"] + (f"({stage['indexName']})" if "indexName" in stage else ""))
+        stage = stage.get("inputStage")
+    stats = plan.get("executionStats", {})
+    return f"{' <- '.join(stages)}, " \
+        f"{stats.get('nReturned')} returned, " \
+        f"{stats.get('totalKeysExamined')} keys and " \
+        f"{stats.get('totalDocsExamined')} documents examined " \
+        f"in {stats.get('executionTimeMillis')}ms"
+
+def tombstone_document(old_object, seq):
+    return old_object | access_fields(old_object) | {
+        "_seq": seq,
+        "_removed": datetime.now(timezone.utc)
+    }
@@ -0,0 +1,139 @@
+import time
+import asyncio
+from os import getenv
+from itertools import count
+from collections import OrderedDict, deque
+
+from . import metrics, tracing
+
+# Sockets that hold more than high_water unsent
+# messages for longer than grace seconds, or
+# more than limit at any time, are disconnected
+high_water = int(getenv('OUTBOX_HIGH_WATER', 1000))
+limit = int(getenv('OUTBOX_LIMIT', 5*high_water))
+grace = float(getenv('OUTBOX_GRACE', 10)) # sec
+
+# Historical frames wait in a separate queue that is
+# only sent from when there is nothing live to send
+history_high_water = int(getenv('OUTBOX_HISTORY_HIGH_WATER', 16))
+
+class Outbox:
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.send_frame = socket.format.sender(socket)
+
+        # Encoded frames waiting to be sent, in order.
+        # Frames that share a key (like updates to the
+        # same object) collapse into the latest version,
+        # which moves behind anything queued since
+        self.pending = OrderedDict() # key -> frame
+        self.keys = count()
+        self.history = deque()
+
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.history_space = asyncio.Event()
+        self.history_empty = asyncio.Event()
+        self.history_empty.set()
+        self.over_since = None
+        self.closed = False
+
+        self.drain_task = asyncio.create_task(self.drain())
+
+    def put(self, frame, key=None):
+        if self.closed: return
+
+        if key is None: key = next(self.keys)
+        self.pending[key] = frame
+        self.pending.move_to_end(key)
+        self.ready.set()
+
+        # Kick out slow consumers
+        if len(self.pending) > limit:
+            self.evict()
+        elif len(self.pending) > high_water:
+            now = time.monotonic()
+            if self.over_since is None:
+                self.over_since = now
+            elif now - self.over_since > grace:
+                self.evict()
+
+    async def send(self, frame):
+        # Wait for the queue to drain below the
+        # high water mark, then queue the frame
+        while len(self.pending) >= high_water and not self.closed:
+            self.space.clear()
+            await self.space.wait()
+        if self.closed:
+            raise Exception("the connection is closed")
+        self.put(frame)
+
+    async def send_history(self, frame):
+        with tracing.span('send'):
+            while len(self.history) >= history_high_water and not self.closed:
+                self.history_space.clear()
+                await self.history_space.wait()
+        if self.closed:
+            raise Exception("the connection is closed")
+        self.history.append(frame)
+        self.history_empty.clear()
+        self.ready.set()
+
+    async def flush_history(self):
+        # Wait until all historical frames have been sent
+        await self.history_empty.wait()
+
+    async def drain(self):
+        try:
+            while True:
+                await self.ready.wait()
+
+                # Live frames go first
+                if self.pending:
+                    key, frame = self.pending.popitem(last=False)
+                    if len(self.pending) < high_water:
+                        self.over_since = None
+                        self.space.set()
+                else:
+                    frame = self.history.popleft()
+                    self.history_space.set()
+                if not self.pending and not self.history:
+                    self.ready.clear()
+
+                with metrics.socket_send.time():
+                    await self.send_frame(frame)
+                if not self.history:
+                    self.history_empty.set()
+        finally:
+            self.closed = True
+            self.space.set()
+            self.history_space.set()
+            self.history_empty.set()
+
+    def evict(self, error='overflow', detail='the connection fell too far behind'):
+        self.close()
+        self.disconnect_task = asyncio.create_task(self.disconnect(error, detail))
+
+    async def disconnect(self, error, detail):
+        try:
+            async with asyncio.timeout(grace):
+                await self.send_frame(self.socket.format.dumps({
+                    'error': error,
+                    'detail': detail
+                }))
+        except:
+            pass
+        try:
+            await self.socket.close(code=1013)
+        except:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        self.history.clear()
+        self.space.set()
+        self.history_space.set()
+        self.history_empty.set()
+        self.drain_task.cancel()
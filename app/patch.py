@@ -0,0 +1,22 @@
+def diff(old, new, path='', operations=None):
+    # A JSON Patch (RFC 6902) that turns one object into
+    # another. Nested objects are patched field by field,
+    # anything else that changed is replaced whole.
+    if operations is None: operations = []
+    for key in old.keys() - new.keys():
+        operations.append({ "op": "remove", "path": path + '/' + escape(key) })
+    for key, value in new.items():
+        key_path = path + '/' + escape(key)
+        if key not in old:
+            operations.append({ "op": "add", "path": key_path, "value": value })
+        elif old[key] == value:
+            continue
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            diff(old[key], value, key_path, operations)
+        else:
+            operations.append({ "op": "replace", "path": key_path, "value": value })
+    return operations
+
+def escape(key):
+    # JSON Pointer escaping
+    return key.replace('~', '~0').replace('/', '~1')
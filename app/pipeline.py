@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from os import getenv
+
+# The most requests from one socket that are handled at
+# once. Reading from the socket pauses beyond this.
+limit = int(getenv('PIPELINE_LIMIT', 16))
+
+logger = logging.getLogger('uvicorn.error')
+
+class Pipeline:
+    # Handles the requests from a socket concurrently.
+    # Replies are matched up by messageID, so only requests
+    # that touch the same thing need to wait for each other.
+
+    def __init__(self, handle, limit=limit):
+        self.handle = handle
+        self.slots = asyncio.Semaphore(limit)
+        self.tails = {} # key -> last task with that key
+        self.tasks = set()
+
+    async def submit(self, msg, *args):
+        await self.slots.acquire()
+
+        # Run after any earlier requests with the same keys.
+        # Everything waits for earlier subscription changes,
+        # so a write sent after a subscribe is seen by it.
+        keys = order_keys(msg)
+        after = { self.tails[key] for key in keys | {'subscriptions'} if key in self.tails }
+        task = asyncio.create_task(self.run(after, msg, *args))
+        for key in keys:
+            self.tails[key] = task
+
+        self.tasks.add(task)
+        task.add_done_callback(lambda task, keys=keys: self.finished(task, keys))
+
+    async def run(self, after, *args):
+        if after:
+            await asyncio.wait(after)
+        await self.handle(*args)
+
+    def finished(self, task, keys):
+        self.tasks.discard(task)
+        self.slots.release()
+        for key in keys:
+            if self.tails.get(key) is task:
+                del self.tails[key]
+        if not task.cancelled() and task.exception():
+            logger.error("request failed", exc_info=task.exception())
+
+    async def close(self):
+        # Let requests that already started finish
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+def order_keys(msg):
+    # Writes to the same object and changes to the
+    # subscriptions are kept in the order they arrive.
+    # Malformed messages fail validation so order
+    # doesn't matter for them.
+    try:
+        if 'update' in msg:
+            keys = [msg['update']['id']]
+        elif 'remove' in msg:
+            keys = [msg['remove']]
+        elif 'updateMany' in msg:
+            keys = [ object['id'] for object in msg['updateMany'] ]
+        elif 'removeMany' in msg:
+            keys = list(msg['removeMany'])
+        elif 'subscribe' in msg or 'unsubscribe' in msg:
+            keys = ['subscriptions']
+        else:
+            keys = []
+    except:
+        keys = []
+    return { key for key in keys if isinstance(key, str) }
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import threading
+from os import getenv
+from collections import Counter
+
+# Sending SIGUSR1 to a worker samples what its event
+# loop is doing for profile_seconds and writes the
+# stacks to profile_dir in the folded format that
+# flame graph tools read. The loop isn't interrupted.
+profile_seconds = float(getenv('PROFILE_SECONDS', 30))
+profile_interval = float(getenv('PROFILE_INTERVAL', 0.005)) # sec
+profile_dir = getenv('PROFILE_DIR', '/tmp')
+
+logger = logging.getLogger('uvicorn.error')
+
+sampler = None
+
+def install():
+    # Call from the event loop's thread
+    loop_thread = threading.get_ident()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: start(loop_thread))
+
+def start(loop_thread):
+    global sampler
+    if sampler and sampler.is_alive():
+        logger.warning("already profiling")
+        return
+    path = os.path.join(profile_dir, f"graffiti-{os.getpid()}-{int(time.time())}.folded")
+    sampler = threading.Thread(target=sample, args=(loop_thread, path), daemon=True)
+    sampler.start()
+    logger.info(f"profiling for {profile_seconds}s")
+
+def sample(loop_thread, path):
+    stacks = Counter()
+    end = time.monotonic() + profile_seconds
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(loop_thread)
+        if frame:
+            stacks[fold(frame)] += 1
+        time.sleep(profile_interval)
+
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    logger.info(f"wrote {sum(stacks.values())} samples to {path}")
+
+def fold(frame):
+    # Outermost call first, separated by semicolons
+    calls = []
+    while frame:
+        code = frame.f_code
+        calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(calls))
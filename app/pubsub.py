@@ -1,51 +1,99 @@
 import asyncio
-from datetime import datetime, timezone
+import logging
+from os import getenv
 from contextlib import asynccontextmanager
 
-class PubSub:
+from . import rest, metrics, tracing
+from .rest import audience
+from .patch import diff
+from .relay import Relay
+from .backfill import Backfill, Scheduler
+from .outbox import Outbox
 
-    def __init__(self, db):
-        self.db = db
+# Sockets that ask for batched replay receive frames of
+# up to batch_count objects and roughly batch_size characters
+batch_count = int(getenv('HISTORY_BATCH_COUNT', 500))
+batch_size = int(getenv('HISTORY_BATCH_SIZE', 2**18))
 
-        self.context_to_sockets = {} # context -> set(socket)
+# A backfill that fails to read is started over from a new
+# snapshot this many times before the socket is closed
+backfill_attempts = 3
+backfill_backoff = 0.1 # sec
 
-        self.resume_token = None
-        self.restart_watcher()
+logger = logging.getLogger('uvicorn.error')
 
-    def restart_watcher(self):
-        if hasattr(self, 'watch_task'):
-            self.watch_task.cancel()
-        self.watch_task = asyncio.create_task(self.watch())
+class PubSub:
+
+    def __init__(self, db, relay_path=None):
+        self.db = db
+
+        self.context_to_sockets = {} # context -> actor -> set(socket)
+        self.scheduler = Scheduler()
+        self.unpassed = set() # finished backfills the feed hasn't passed
+
+        # A single change feed is kept open for the
+        # lifetime of the server and changes are filtered
+        # in-process against context_to_sockets, so
+        # (un)subscribing never touches the database.
+        # With multiple workers, one of them watches and
+        # relays the changes to the others.
+        if relay_path:
+            self.relay = Relay(self, relay_path)
+            self.watch_task = asyncio.create_task(self.relay.run())
+        else:
+            self.watch_task = asyncio.create_task(self.watch())
 
     @asynccontextmanager
     async def register(self, socket):
         socket.contexts = set()
+        socket.backfills = set()
+        socket.patch_contexts = set()
+        socket.outbox = Outbox(socket)
 
+        metrics.sockets.inc()
         try:
             yield
         finally:
+            metrics.sockets.dec()
+            socket.outbox.close()
+            for backfill in list(socket.backfills):
+                self.cancel_backfill(backfill)
+
             # Remove all references to the socket
             for context in socket.contexts:
-                self.context_to_sockets[context].remove(socket)
-                if not self.context_to_sockets[context]:
-                    del self.context_to_sockets[context]
-                    self.restart_watcher()
+                self.remove_socket(context, socket)
 
-    async def subscribe(self, contexts, socket):
+    async def subscribe(self, contexts, socket, batch=False, since=None, patch=False):
         for context in contexts:
             if context in socket.contexts:
                 raise Exception(f"you are already subscribed to the context {context}")
 
+        # Removals from before the horizon have been forgotten
+        if since:
+            with tracing.span('db'):
+                horizon = await self.db.sequence_value("horizon")
+            if since < horizon:
+                raise Exception("changes since that point are no longer available, subscribe without \"since\"")
+
+        # Replaces of objects in these contexts are
+        # sent as patches whenever that's safe
+        if patch:
+            socket.patch_contexts.update(contexts)
+
         for context in contexts:
             socket.contexts.add(context)
-            if context not in self.context_to_sockets:
-                self.context_to_sockets[context] = { socket }
-                self.restart_watcher()
-            else:
-                self.context_to_sockets[context].add(socket)
-
-        # In the background, begin processing existing results
-        asyncio.create_task(self.process_existing(contexts, socket))
+            self.context_to_sockets \
+                .setdefault(context, {}) \
+                .setdefault(socket.actor, set()) \
+                .add(socket)
+
+        # In the background, begin processing existing results.
+        # Live changes to these contexts are held back until
+        # the existing results have been sent.
+        backfill = Backfill(socket, contexts)
+        socket.backfills.add(backfill)
+        self.scheduler.submit(backfill,
+            lambda: self.process_existing(contexts, socket, backfill, batch, since))
 
         return 'subscribed'
 
@@ -56,114 +104,341 @@ class PubSub:
 
         for context in contexts:
             socket.contexts.remove(context)
-            self.context_to_sockets[context].remove(socket)
-            if not self.context_to_sockets[context]:
-                del self.context_to_sockets[context]
-                self.restart_watcher()
+            socket.patch_contexts.discard(context)
+            self.remove_socket(context, socket)
+
+        # Stop sending existing results that are
+        # no longer wanted by any of the contexts
+        for backfill in list(socket.backfills):
+            backfill.contexts.difference_update(contexts)
+            if not backfill.contexts:
+                self.cancel_backfill(backfill)
 
         return 'unsubscribed'
 
-    # Initialize database interfaces
-    async def watch(self):
+    def lose_changes(self):
+        # Changes were missed, so every subscriber
+        # has to subscribe again to catch up
+        sockets = set()
+        for actor_to_sockets in self.context_to_sockets.values():
+            for actor_sockets in actor_to_sockets.values():
+                sockets.update(actor_sockets)
+        logger.warning(f"changes were lost, closing {len(sockets)} sockets")
+        for socket in sockets:
+            socket.outbox.evict('resubscribe', 'changes were missed, subscribe again')
+
+    def cancel_backfill(self, backfill):
+        self.scheduler.cancel(backfill)
+        backfill.held.clear()
+        self.drop_backfill(backfill)
+
+    def drop_backfill(self, backfill):
+        backfill.socket.backfills.discard(backfill)
+        self.unpassed.discard(backfill)
+
+    def remove_socket(self, context, socket):
+        # Anonymous sockets are grouped under None
+        actor_to_sockets = self.context_to_sockets[context]
+        actor_to_sockets[socket.actor].remove(socket)
+        if not actor_to_sockets[socket.actor]:
+            del actor_to_sockets[socket.actor]
+            if not actor_to_sockets:
+                del self.context_to_sockets[context]
 
-        contexts_query = { "$in": list(self.context_to_sockets.keys()) }
-        async with self.db.watch(
-                [ { '$match' : { '$or': [
-                    { 'fullDocument.context': { "$elemMatch": contexts_query }},
-                    { 'fullDocumentBeforeChange.context': { "$elemMatch": contexts_query }},
-                    { "fullDocument.id": contexts_query },
-                    { "fullDocumentBeforeChange.id": contexts_query }
-                ]}}],
-                full_document='whenAvailable',
-                full_document_before_change='whenAvailable',
-                resume_after=self.resume_token) as stream:
-
-            async for change in stream:
-                tasks = []
-
-                # Create a set of tasks for sending
-                # messages to relevant sockets
-                contexts_new = denied_sockets = []
-                if 'fullDocument' in change:
-                    obj = change['fullDocument']
-                    contexts_new = obj["context"]
-                    del obj['_id']
-                    denied_sockets = self.collect_tasks(obj, tasks, "update")
-
-                if 'fullDocumentBeforeChange' in change:
-
-                    obj = change['fullDocumentBeforeChange']
-                    obj = {
-                        "id": obj["id"],
-                        "actor": obj["actor"],
-                        "context": obj["context"]
-                    }
-
-                    # If users have permission to see the old
-                    # object but not the new, send a removal
-                    for socket in denied_sockets:
-                        self.task_with_permission(socket, obj, tasks, "remove")
-
-                    # Now only consider old contexts and don't consider denied sockets
-                    obj["context"] = list(set(obj["context"]) - set(contexts_new))
-                    self.collect_tasks(obj, tasks, "remove",
-                            done_sockets=denied_sockets,
-                            with_id='fullDocument' not in change)
-
-                # Send the changes
-                await asyncio.shield(asyncio.gather(*tasks))
-                self.resume_token = stream.resume_token
-
-    def collect_tasks(self, obj, tasks, msg, done_sockets=None, with_id=True):
-        if not done_sockets: done_sockets = set()
-        denied_sockets = set()
-
-        contexts = obj["context"]
-        if with_id: contexts = contexts + [obj["id"]]
-        for context in contexts:
-            if context not in self.context_to_sockets: continue
-
-            # Ignore sockets that have already
-            # been considered for sending
-            for socket in self.context_to_sockets[context] - done_sockets:
-                done_sockets.add(socket)
-                if not self.task_with_permission(socket, obj, tasks, msg):
-                    denied_sockets.add(socket)
-
-        return denied_sockets
-
-    def task_with_permission(self, socket, obj, tasks, msg):
-        has_permission = socket.actor == obj['actor'] or \
-            (('bto' not in obj) and ('bcc' not in obj)) or \
-            ('bto' in obj and socket.actor in obj['bto']) or \
-            ('bcc' in obj and socket.actor in obj['bcc'])
-
-        if has_permission:
-            tasks.append(socket.send_json({msg: obj, "historical": False}))
-        return has_permission
-
-    async def process_existing(self, contexts, socket):
-        
-        query = { "$and": [
-            # Access
-            { "$or": [
-                # The object is public
-                {  "bto": { "$exists": False },
-                   "bcc": { "$exists": False } },
-
-                # The actor is the recipient or sender
-                { "bto":   socket.actor },
-                { "bcc":   socket.actor },
-                { "actor": socket.actor }]},
-            # Context
-            { "$or": [
-                { "context": { "$elemMatch": { "$in": contexts } } },
-                { "id": { "$in": contexts }}]}
-        ]}
-
-        async for obj in self.db.find(query):
-            del obj["_id"]
+    async def watch(self):
+        # The feed retries its own database errors,
+        # anything else starts it over
+        while True:
             try:
-                await socket.send_json({ "update": obj, "historical": True })
-            except Exception as e:
+                async for change in self.changes():
+                    self.dispatch(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("change feed failed, restarting")
+                await asyncio.sleep(1)
+
+    def changes(self):
+        return self.db.changes()
+
+    def dispatch(self, change):
+        # One bad change must not stop the feed
+        try:
+            self.publish(change)
+        except Exception:
+            logger.exception(f"could not dispatch change {change.get('_id')}")
+
+    def publish(self, change):
+        # Queue messages for relevant sockets. Each socket's
+        # outbox sends them in the background so a slow
+        # socket does not hold up any of the others
+        metrics.changes.inc()
+
+        # An image that has expired comes back as null,
+        # route the change with whichever one is left
+        change = { k: v for k, v in change.items() if v is not None }
+
+        # Once the feed is past a snapshot, live changes
+        # can't be part of it, whatever they touch
+        for backfill in [ b for b in self.unpassed if change['clusterTime'] > b.time ]:
+            self.drop_backfill(backfill)
+        if 'fullDocument' not in change and 'fullDocumentBeforeChange' not in change:
+            logger.warning(f"change {change.get('_id')} has no document to route")
+        trace = tracing.begin('change')
+        new_sockets = set()
+        reached = set()
+        if 'fullDocument' in change:
+            obj = change['fullDocument']
+            new_keys = rest.keys(obj)
+            for field in rest.hidden_fields:
+                obj.pop(field, None)
+            seq = obj.pop('_seq', None)
+            new_audience = audience(obj)
+            new_sockets = self.route(new_keys, new_audience)
+            patched = set()
+            if 'fullDocumentBeforeChange' in change and any(s.patch_contexts for s in new_sockets):
+                patched = self.send_patch(new_sockets, new_keys, obj,
+                    change['fullDocumentBeforeChange'], change['clusterTime'], seq)
+            self.send(new_sockets - patched, obj, "update", change['clusterTime'], seq)
+            reached |= new_sockets
+
+        if 'fullDocumentBeforeChange' in change:
+            old = change['fullDocumentBeforeChange']
+            old_audience = audience(old)
+            obj = {
+                "id": old["id"],
+                "actor": old["actor"],
+                "context": old["context"]
+            }
+
+            if 'fullDocument' not in change:
+                # The sequence value of the removal
+                # is only known to its tombstone
+                old_sockets = self.route(rest.keys(old), old_audience)
+                self.send(old_sockets, obj, "remove", change['clusterTime'])
+                reached |= old_sockets
+            else:
+                # Sockets that lost permission lose the object entirely
+                denied_sockets = set()
+                if new_audience is not None:
+                    denied_sockets = {
+                        s for s in self.route(rest.keys(old), old_audience) - new_sockets
+                        if s.actor not in new_audience }
+                self.send(denied_sockets, obj, "remove", change['clusterTime'], seq)
+
+                # The rest lose the contexts it was removed from,
+                # even if they also got the update. These don't
+                # collapse with the update or with each other.
+                removed = list(set(obj["context"]) - set(change['fullDocument']["context"]))
+                removed_sockets = self.route(removed, old_audience) - denied_sockets
+                obj = obj | { "context": removed }
+                self.send(removed_sockets, obj, "remove", change['clusterTime'], seq, collapse=False)
+                reached |= denied_sockets | removed_sockets
+
+        metrics.fanout.observe(len(reached))
+        tracing.end(trace, f"{len(reached)} sockets")
+
+    def send_patch(self, sockets, new_keys, obj, old, time, seq):
+        # Sockets that asked for patches in every context
+        # they see the object under and are sure to have
+        # the previous version get only what changed. That
+        # rules out sockets still receiving existing results
+        # for the object and ones with an unsent frame for
+        # it, which the patch would replace.
+        old_keys = rest.keys(old)
+        keys = set(new_keys) | set(old_keys)
+        sockets = { s for s in sockets if (s.contexts & keys) <= s.patch_contexts
+            and all(b.contexts.isdisjoint(keys) for b in s.backfills)
+            and obj["id"] not in s.outbox.pending }
+        sockets &= self.route(old_keys, audience(old))
+        if not sockets: return sockets
+
+        old = { k: v for k, v in old.items() if k not in rest.hidden_fields and k != '_seq' }
+        patch = { "id": obj["id"], "actor": obj["actor"], "operations": diff(old, obj) }
+        self.send(sockets, patch, "patch", time, seq, keys=keys)
+        return sockets
+
+    def route(self, keys, audience):
+        # Collect the sockets subscribed to any of the
+        # object's keys that are allowed to see it.
+        # Public objects go to every socket, private ones
+        # are only looked up for each member of the audience.
+        with tracing.span('route'):
+            sockets = set()
+            for key in keys:
+                if key not in self.context_to_sockets: continue
+                actor_to_sockets = self.context_to_sockets[key]
+
+                if audience is None:
+                    for actor_sockets in actor_to_sockets.values():
+                        sockets.update(actor_sockets)
+                else:
+                    for actor in audience:
+                        if actor in actor_to_sockets:
+                            sockets.update(actor_to_sockets[actor])
+
+            return sockets
+
+    def send(self, sockets, obj, msg, time, seq=None, collapse=True, keys=None):
+        # The keys are what the frame is routed under, which
+        # default to the object's, for checking it against
+        # backfills in progress
+        if not sockets: return
+        with tracing.span('send'):
+            key = obj["id"] if collapse else None
+
+            # Encode once per format and share the frame
+            message = { msg: obj, "historical": False }
+            if seq is not None: message["seq"] = seq
+            frames = {}
+
+            for socket in sockets:
+                frame = frames.get(socket.format)
+                if frame is None:
+                    frame = frames[socket.format] = socket.format.dumps(message)
+                if socket.backfills:
+                    if keys is None: keys = set(obj["context"] + [obj["id"]])
+                    if not self.hand_off(socket, keys, key, frame, time):
+                        continue
+                socket.outbox.put(frame, key)
+
+    def hand_off(self, socket, keys, key, frame, time):
+        # Decide whether a live frame can be sent now or
+        # whether it overlaps with existing results
+        for backfill in list(socket.backfills):
+            if backfill.contexts.isdisjoint(keys): continue
+
+            # Hold it until the existing results are sent
+            if not backfill.done:
+                backfill.held.pop(key, None)
+                backfill.held[object() if key is None else key] = (time, frame, key)
+                return False
+
+            # It is already part of the existing results
+            if time <= backfill.time:
+                return False
+
+            # The change feed has moved past the
+            # existing results, stop checking them
+            self.drop_backfill(backfill)
+
+        return True
+
+    async def process_existing(self, contexts, socket, backfill, batch=False, since=None):
+        # The existing results are read from a snapshot so
+        # that they line up exactly with the change feed
+        trace = tracing.begin('backfill', backfill.created)
+        for attempt in range(backfill_attempts):
+            try:
+                async with self.db.snapshot() as snapshot:
+                    await self.replay_existing(snapshot, contexts, backfill, batch, since)
+                backfill.time = snapshot.time
                 break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Nothing more can be sent to a closed socket
+                if socket.outbox.closed: return
+                # Results sent so far are sent again, which the
+                # client treats like any other repeated update
+                logger.warning(f"backfill failed, attempt {attempt+1} of {backfill_attempts}: {e!r}")
+                await asyncio.sleep(backfill_backoff * 2**attempt)
+        else:
+            # The client would be left with partial results,
+            # so hang up and let it subscribe again
+            socket.outbox.evict('backfill', 'existing results could not be read, subscribe again')
+            return
+
+        await self.finish_backfill(socket, backfill)
+        tracing.end(trace, f"{len(contexts)} contexts")
+
+    async def replay_existing(self, snapshot, contexts, backfill, batch, since):
+        # Contexts that are unsubscribed from in the
+        # meantime are left out of queries not yet made,
+        # and of results of the ones already running
+        socket = backfill.socket
+        remaining = lambda: [ c for c in contexts if c in backfill.contexts ]
+
+        if since is None:
+            await self.replay(snapshot.objects(socket.actor, remaining()),
+                socket, "update", batch, backfill.contexts)
+            return
+
+        # Only replay changes after the watermark. Removals
+        # come first because an object that was removed and
+        # then written again has a later sequence value
+        seq = await snapshot.sequence_value()
+        if since:
+            seq = max(seq, await self.replay(snapshot.tombstones(socket.actor, remaining(), since),
+                socket, "remove", batch, backfill.contexts))
+        seq = max(seq, await self.replay(snapshot.objects(socket.actor, remaining(), since),
+            socket, "update", batch, backfill.contexts))
+
+        # Tell the socket where to pick up from next time
+        await socket.outbox.send_history(socket.format.dumps({
+            "replayed": remaining(),
+            "seq": seq,
+            "historical": True
+        }))
+
+    async def finish_backfill(self, socket, backfill):
+        # Release the live changes that happened after the
+        # snapshot and drop the ones that were already in it.
+        # If the snapshot time is unknown, release everything.
+        # Live frames jump ahead of historical ones, so wait
+        # for those to be sent first.
+        await socket.outbox.flush_history()
+        backfill.done = True
+        passed = backfill.time is None
+        for time, frame, key in backfill.held.values():
+            if backfill.time is None or time > backfill.time:
+                socket.outbox.put(frame, key)
+                passed = True
+        backfill.held.clear()
+
+        # Until the change feed passes the snapshot,
+        # later changes may still be part of it
+        if passed:
+            socket.backfills.discard(backfill)
+        elif backfill in socket.backfills:
+            self.unpassed.add(backfill)
+
+    async def replay(self, cursor, socket, msg, batch, contexts):
+        # Send the results of a query that are still in
+        # one of the contexts as historical messages and
+        # return the largest sequence value sent
+        max_seq = 0
+        dumps, batch_frame = socket.format.dumps, socket.format.batch_frame
+        wanted = lambda obj: obj["id"] in contexts or not contexts.isdisjoint(obj["context"])
+        try:
+            if not batch:
+                async for obj in cursor:
+                    if not wanted(obj): continue
+                    frame = { msg: obj, "historical": True }
+                    if '_seq' in obj:
+                        frame["seq"] = obj.pop('_seq')
+                        max_seq = max(max_seq, frame["seq"])
+                    await socket.outbox.send_history(dumps(frame))
+                    metrics.backfill_objects.inc()
+                return max_seq
+
+            # Objects are encoded individually so the
+            # frame can be cut once it gets big enough
+            objs, size, seq = [], 0, 0
+            async for obj in cursor:
+                if not wanted(obj): continue
+                seq = max(seq, obj.pop('_seq', 0))
+                objs.append(dumps(obj))
+                size += len(objs[-1])
+                if len(objs) >= batch_count or size >= batch_size:
+                    await socket.outbox.send_history(batch_frame(objs, msg, seq))
+                    metrics.backfill_objects.inc(len(objs))
+                    objs, size, max_seq, seq = [], 0, max(max_seq, seq), 0
+            if objs:
+                await socket.outbox.send_history(batch_frame(objs, msg, seq))
+                metrics.backfill_objects.inc(len(objs))
+                max_seq = max(max_seq, seq)
+            return max_seq
+
+        finally:
+            await cursor.close()
@@ -0,0 +1,152 @@
+import os
+import bson
+import fcntl
+import asyncio
+import logging
+from os import getenv
+from collections import deque
+
+# Followers that fall this far behind are dropped
+max_buffer = int(getenv('RELAY_MAX_BUFFER', 2**26)) # bytes
+
+# Recent changes are kept so that a follower that
+# reconnects can pick up from its last one
+history = int(getenv('RELAY_HISTORY', 1000)) # changes
+
+# The parts of a change that are needed for routing
+relayed_fields = ['_id', 'clusterTime', 'fullDocument', 'fullDocumentBeforeChange']
+
+logger = logging.getLogger('uvicorn.error')
+
+class Relay:
+    # Shares one change feed among the worker processes
+    # on a host. Whichever worker holds the lock watches the
+    # database and relays each change to the others over a
+    # Unix socket. If it exits, another worker takes over.
+    # Followers say which change they saw last when they
+    # connect and the leader sends them what they missed.
+
+    def __init__(self, pubsub, path):
+        self.pubsub = pubsub
+        self.path = path
+        self.followers = set()
+        self.recent = deque(maxlen=history) # (resume token, data)
+
+    async def run(self):
+        with open(self.path + '.lock', 'w') as lock:
+            while True:
+                try:
+                    await self.take_turn(lock)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("relay failed, restarting")
+                    await asyncio.sleep(1)
+
+    async def take_turn(self, lock):
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            await self.follow()
+        else:
+            try:
+                await self.lead()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def lead(self):
+        # Any socket file left over is from a dead leader
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        # The feed picks up from the last change
+        # this worker saw, followers who saw the
+        # same one haven't missed anything
+        self.recent.clear()
+        if self.pubsub.db.resume_token is not None:
+            self.recent.append((self.pubsub.db.resume_token, None))
+        server = await asyncio.start_unix_server(self.accept, self.path)
+
+        try:
+            async for change in self.pubsub.changes():
+                # BSON documents carry their own length,
+                # so they can be written back to back
+                data = bson.encode({ k: change[k] for k in relayed_fields if k in change })
+                self.recent.append((change['_id'], data))
+                for writer in list(self.followers):
+                    if writer.transport.get_write_buffer_size() > max_buffer:
+                        self.followers.discard(writer)
+                        writer.close()
+                    else:
+                        writer.write(data)
+
+                self.pubsub.dispatch(change)
+        finally:
+            server.close()
+            for writer in self.followers:
+                writer.close()
+            self.followers.clear()
+
+    async def accept(self, reader, writer):
+        try:
+            hello = await read_document(reader)
+
+            # Catch up before any new changes are written.
+            # If the follower's last change is too old, it
+            # has to tell its sockets what was lost.
+            if hello['after'] is not None:
+                missed = self.missed(hello['after'])
+                if missed is None:
+                    writer.write(bson.encode({ 'lost': True }))
+                else:
+                    for data in missed:
+                        writer.write(data)
+            self.followers.add(writer)
+
+            await reader.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.followers.discard(writer)
+            writer.close()
+
+    def missed(self, token):
+        # The changes after the one with the given
+        # resume token, or None if it is not kept
+        missed = None
+        for recent_token, data in self.recent:
+            if missed is not None:
+                missed.append(data)
+            elif recent_token == token:
+                missed = []
+        return missed
+
+    async def follow(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError:
+            # The leader is not listening yet
+            await asyncio.sleep(0.1)
+            return
+
+        try:
+            writer.write(bson.encode({ 'after': self.pubsub.db.resume_token }))
+            while True:
+                change = await read_document(reader)
+                if 'lost' in change:
+                    self.pubsub.lose_changes()
+                    continue
+
+                # Keep the position in case this
+                # worker has to take over
+                self.pubsub.db.resume_token = change['_id']
+                self.pubsub.dispatch(change)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def read_document(reader):
+    size = await reader.readexactly(4)
+    data = size + await reader.readexactly(int.from_bytes(size, 'little') - 4)
+    return bson.decode(data)
@@ -1,7 +1,24 @@
+from os import getenv
+from hashlib import blake2b
+from collections import Counter
+
+from . import tracing
 from .schema import parse_object_URL
+from .codec import dumps
 
+# Tombstones of removed objects are kept for this long
+# so that clients can catch up with "since" subscriptions
+tombstone_retention = 60*60*float(getenv('TOMBSTONE_RETENTION', 24*7)) # hours -> sec
 
-async def update(db, object, actor):
+# Fields maintained by the server that clients don't see
+hidden_fields = ["_id", "_hash", "_keys", "_access"]
+
+missing_error = """\
+the object you're trying to modify either \
+doesn't exist or you don't have permission \
+to modify it."""
+
+def check_update(object, actor):
     # Make sure the actor is logged in
     if not actor:
         raise Exception("you can't modify objects without logging in.")
@@ -14,17 +31,7 @@ async def update(db, object, actor):
     if parse_object_URL(object["id"])[0] != actor:
         raise Exception("object ID is inconsistent with actor.")
 
-    # Insert the new object
-    old_object = await db.find_one_and_replace({
-        "id": object["id"],
-    }, object, upsert=True)
-
-    if old_object:
-        return "replaced"
-    else:
-        return "inserted"
-
-async def remove(db, object_id, actor):
+def check_remove(object_id, actor):
     # Make sure the actor is logged in
     if not actor:
         raise Exception("you can't modify objects without logging in.")
@@ -33,35 +40,119 @@ async def remove(db, object_id, actor):
     if parse_object_URL(object_id)[0] != actor:
         raise Exception("object ID is inconsistent with actor.")
 
-    old_object = await db.find_one_and_delete({
-        "id": object_id,
-    })
+async def update(db, object, actor):
+    check_update(object, actor)
+    with tracing.span('db'):
+        return await db.update(object, actor)
 
-    if not old_object:
-        raise Exception("""\
-the object you're trying to modify either \
-doesn't exist or you don't have permission \
-to modify it.""")
+async def update_many(db, objects, actor):
+    # Check every object like a single update
+    # and write the ones that pass together
+    results = [ None ] * len(objects)
+    indices = check_many(objects, results,
+        lambda object: check_update(object, actor),
+        lambda object: object["id"])
+    if not indices: return results
 
-    return "removed"
+    with tracing.span('db'):
+        replies = await db.update_many([ objects[i] for i in indices.values() ], actor)
+    for i, reply in zip(indices.values(), replies):
+        results[i] = reply
+    return results
+
+async def remove(db, object_id, actor):
+    check_remove(object_id, actor)
+    with tracing.span('db'):
+        return await db.remove(object_id, actor)
+
+async def remove_many(db, object_ids, actor):
+    # Check every id like a single removal
+    # and remove the ones that pass together
+    results = [ None ] * len(object_ids)
+    indices = check_many(object_ids, results,
+        lambda object_id: check_remove(object_id, actor),
+        lambda object_id: object_id)
+    if not indices: return results
+
+    with tracing.span('db'):
+        replies = await db.remove_many(list(indices), actor)
+    for i, reply in zip(indices.values(), replies):
+        results[i] = reply
+    return results
+
+def check_many(items, results, check, key):
+    # Check each item of a batch, recording errors in
+    # results, and return the valid ones by id
+    indices = {}
+    for i, item in enumerate(items):
+        try:
+            check(item)
+            if key(item) in indices:
+                raise Exception("the object appears more than once in the batch.")
+            indices[key(item)] = i
+        except Exception as e:
+            results[i] = { "error": str(e) }
+    return indices
 
 async def contexts(db, actor):
-    async for doc in db.aggregate([
-        { "$match": {
-            "actor": actor,
-        }},
-        { "$project": {
-            "_id": 0,
-            "context": 1,
-        }},
-        { "$unwind": {
-            "path": "$context"
-        }},
-        { "$group": {
-            "_id": None,
-            "context": { "$addToSet": "$context" }
-        }}]):
-
-        return doc["context"]
-    else:
-        return []
+    with tracing.span('db'):
+        return await db.contexts(actor)
+
+async def purge(db):
+    await db.purge()
+
+def context_changes(new_contexts, old_contexts, changes=None):
+    # How the number of objects in each context changes
+    if changes is None: changes = Counter()
+    for context in set(new_contexts) - set(old_contexts):
+        changes[context] += 1
+    for context in set(old_contexts) - set(new_contexts):
+        changes[context] -= 1
+    return changes
+
+def audience(obj):
+    # The actors who can see an object,
+    # or None if the object is public
+    if 'bto' not in obj and 'bcc' not in obj:
+        return None
+    return { obj['actor'], *obj.get('bto', []), *obj.get('bcc', []) }
+
+def content_hash(obj):
+    # Objects are compared as they were sent
+    return blake2b(dumps(obj).encode(), digest_size=16).hexdigest()
+
+def keys(obj):
+    # A stored object can be found by any of
+    # its contexts or by its own id
+    if "_keys" in obj:
+        return obj["_keys"]
+    return obj["context"] + [obj["id"]]
+
+def access_fields(obj):
+    # The object's keys, and each of them paired
+    # with everyone who can read the object. MongoDB
+    # can't index two arrays together, so the pairs let
+    # one index find exactly what a reader can see under
+    # a key: "public KEY" or "ACTOR KEY".
+    readers = audience(obj)
+    readers = ["public"] if readers is None else sorted(readers)
+    obj_keys = obj["context"] + [obj["id"]]
+    return {
+        "_keys": obj_keys,
+        "_access": [ f"{r} {k}" for r in readers for k in obj_keys ]
+    }
+
+def access_pairs(actor, keys):
+    # The pairs a reader can see under some keys
+    readers = ["public"] + ([actor] if actor else [])
+    return [ f"{r} {k}" for r in readers for k in keys ]
+
+def lost_access(old_object, object):
+    # Whether anyone who could see the old object
+    # in some context can't see the new one there
+    if not set(old_object["context"]) <= set(object["context"]):
+        return True
+    old_audience, new_audience = audience(old_object), audience(object)
+    if new_audience is None:
+        return False
+    return old_audience is None or not old_audience <= new_audience
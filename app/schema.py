@@ -1,5 +1,6 @@
 import re
-from jsonschema import Draft7Validator
+
+from .validator import compile_validator
 
 sha_regex = "[0-9a-f]{64}"
 random_regex = ".{1,64}"
@@ -17,14 +18,34 @@ schema = {
         "messageID": { "$ref": "#/definitions/randomID" },
         "update": { "$ref": "#/definitions/object" },
         "remove": { "$ref": "#/definitions/objectURL" },
+        "updateMany": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": 1000,
+            "items": { "$ref": "#/definitions/object" }
+        },
+        "removeMany": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": 1000,
+            "items": { "$ref": "#/definitions/objectURL" }
+        },
         "subscribe": { "$ref": "#/definitions/context" },
         "unsubscribe": { "$ref": "#/definitions/context" },
-        "ls": { "type": "null" }
+        "ls": { "type": "null" },
+        "batch": { "type": "boolean" },
+        "since": { "type": "integer", "minimum": 0 },
+        "patch": { "type": "boolean" }
     },
     "additionalProperties": False,
+    "dependencies": {
+        "batch": ["subscribe"],
+        "since": ["subscribe"],
+        "patch": ["subscribe"]
+    },
     "oneOf": [
         { "required": ["messageID", x] } for x in \
-        ["update", "remove", "subscribe", "unsubscribe", "ls"]
+        ["update", "remove", "updateMany", "removeMany", "subscribe", "unsubscribe", "ls"]
     ],
     "definitions": {
         "object": {
@@ -73,5 +94,4 @@ schema = {
     }
 }
 
-validator = Draft7Validator(schema, format_checker=Draft7Validator.FORMAT_CHECKER)
-validate = lambda msg: validator.validate(msg)
+validate = compile_validator(schema)
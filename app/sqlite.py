@@ -0,0 +1,413 @@
+import time
+import sqlite3
+import asyncio
+import threading
+from os import getenv
+from collections import Counter
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics, tracing
+from .codec import dumps, loads
+from .backfill import concurrency
+from .rest import tombstone_retention, missing_error, \
+    content_hash, access_fields, access_pairs, lost_access, context_changes
+
+# The database file, opened in WAL mode so that
+# readers never wait for the writer
+path = getenv('SQLITE_PATH', 'graffiti.db')
+
+# Writes made in this process are picked up right away,
+# writes from other processes are polled for this often
+poll_interval = float(getenv('SQLITE_POLL_INTERVAL', 0.1)) # sec
+
+# Changes are kept for a while in case another
+# worker takes over the feed and has to catch up
+change_retention = 60*float(getenv('SQLITE_CHANGE_RETENTION', 10)) # min -> sec
+
+# Historical objects and changes are read in batches of this many
+cursor_batch_size = int(getenv('HISTORY_CURSOR_BATCH_SIZE', 1000))
+
+# Objects are stored as JSON along with the pairs of readers
+# and keys that can see them, like the _access field in MongoDB.
+# Every write also appends to the changes table, which is
+# the change feed.
+schema = """
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    actor TEXT NOT NULL,
+    data TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_seq ON objects (seq);
+
+CREATE TABLE IF NOT EXISTS access (
+    pair TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (pair, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS access_id ON access (id);
+
+CREATE TABLE IF NOT EXISTS tombstones (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    actor TEXT NOT NULL,
+    context TEXT NOT NULL,
+    removed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tombstones_removed ON tombstones (removed);
+
+CREATE TABLE IF NOT EXISTS tombstone_access (
+    pair TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (pair, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tombstone_access_seq ON tombstone_access (seq);
+
+CREATE TABLE IF NOT EXISTS contexts (
+    actor TEXT NOT NULL,
+    context TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (actor, context)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    new TEXT,
+    old TEXT
+);
+"""
+
+find_object = 'SELECT data, hash FROM objects WHERE id = ?'
+find_contexts = 'SELECT context FROM contexts WHERE actor = ?'
+
+def connect():
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA busy_timeout=5000')
+    return connection
+
+class SQLiteStorage:
+    # Objects live in a local SQLite file. All writes go
+    # through one thread while reads use a pool of threads
+    # with a connection each.
+
+    def __init__(self):
+        self.writer = ThreadPoolExecutor(1)
+        self.readers = ThreadPoolExecutor(concurrency + 1)
+        self.connection = None
+        self.local = threading.local()
+        self.changed = asyncio.Event()
+        self.resume_token = None
+        self.lag = 0
+
+    async def setup(self):
+        def create(db):
+            db.executescript(schema)
+        await self.run(self.writer, create, self.write_connection)
+
+    async def run(self, executor, function, connection, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor,
+            lambda: function(connection(), *args))
+
+    def write_connection(self):
+        if not self.connection:
+            self.connection = connect()
+        return self.connection
+
+    def read_connection(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = connect()
+        return self.local.connection
+
+    async def write(self, function, *args):
+        # Each write is one transaction. Wake up the
+        # change feed as soon as it is committed.
+        try:
+            return await self.run(self.writer, transaction, self.write_connection, function, *args)
+        finally:
+            self.changed.set()
+
+    async def read(self, function, *args):
+        return await self.run(self.readers, function, self.read_connection, *args)
+
+    def explain(self, name, sql, params):
+        tracing.query(name, lambda: self.read(explain, sql, params))
+
+    async def update(self, object, actor):
+        self.explain('object', find_object, (object["id"],))
+        return await self.write(write_update, object, actor)
+
+    async def update_many(self, objects, actor):
+        self.explain('object', find_object, (objects[0]["id"],))
+        return await self.write(write_update_many, objects, actor)
+
+    async def remove(self, object_id, actor):
+        self.explain('object', find_object, (object_id,))
+        reply = await self.write(write_remove, object_id, actor)
+        if not reply:
+            raise Exception(missing_error)
+        return reply
+
+    async def remove_many(self, object_ids, actor):
+        self.explain('object', find_object, (object_ids[0],))
+        return await self.write(write_remove_many, object_ids, actor)
+
+    async def contexts(self, actor):
+        self.explain('contexts', find_contexts, (actor,))
+        def read_contexts(db):
+            return [ context for context, in db.execute(find_contexts, (actor,)) ]
+        return await self.read(read_contexts)
+
+    async def sequence_value(self, name="seq"):
+        return await self.read(counter_value, name)
+
+    async def purge(self):
+        await self.write(write_purge)
+
+    async def changes(self):
+        # Start from the latest change unless
+        # taking over from another worker
+        if self.resume_token is None:
+            self.resume_token = await self.read(latest_change)
+
+        while True:
+            self.changed.clear()
+            try:
+                rows = await self.read(changes_after, self.resume_token)
+            except sqlite3.Error:
+                # Try again from the same change
+                metrics.feed_restarts.inc()
+                await asyncio.sleep(poll_interval)
+                continue
+            for id_, change_time, new, old in rows:
+                change = { "_id": id_, "clusterTime": id_ }
+                if new is not None: change["fullDocument"] = loads(new)
+                if old is not None: change["fullDocumentBeforeChange"] = loads(old)
+                self.resume_token = id_
+                self.lag = time.time() - change_time
+                yield change
+
+            # Wait for a local write or poll for others
+            if len(rows) < cursor_batch_size:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    @asynccontextmanager
+    async def snapshot(self):
+        # A read transaction sees the database as of its
+        # first statement, which reads the latest change
+        snapshot = SQLiteSnapshot(self, connect())
+        try:
+            snapshot.time = await snapshot.run(begin_snapshot)
+            yield snapshot
+        finally:
+            await snapshot.run(end_snapshot)
+
+class SQLiteSnapshot:
+
+    def __init__(self, storage, connection):
+        self.storage = storage
+        self.connection = connection
+        self.time = None
+
+    async def run(self, function, *args):
+        return await self.storage.run(self.storage.readers, function, lambda: self.connection, *args)
+
+    async def sequence_value(self):
+        # The last sequence value written as of the snapshot
+        return await self.run(counter_value, "seq")
+
+    def objects(self, actor, contexts, since=None):
+        pairs = access_pairs(actor, contexts)
+        sql = f'''SELECT data, seq FROM objects WHERE id IN
+            (SELECT id FROM access WHERE pair IN ({','.join('?'*len(pairs))}))'''
+        if since:
+            sql += ' AND seq > ?'
+            pairs.append(since)
+        self.storage.explain('objects', sql, pairs)
+        return SQLiteCursor(self, sql, pairs,
+            lambda row: loads(row[0]) | { "_seq": row[1] })
+
+    def tombstones(self, actor, contexts, since):
+        pairs = access_pairs(actor, contexts)
+        sql = f'''SELECT id, actor, context, seq FROM tombstones WHERE seq IN
+            (SELECT seq FROM tombstone_access WHERE pair IN ({','.join('?'*len(pairs))}))
+            AND seq > ?'''
+        self.storage.explain('tombstones', sql, pairs + [since or 0])
+        return SQLiteCursor(self, sql, pairs + [since or 0],
+            lambda row: { "id": row[0], "actor": row[1], "context": loads(row[2]), "_seq": row[3] })
+
+class SQLiteCursor:
+    # Reads query results in batches from a snapshot
+
+    def __init__(self, snapshot, sql, params, decode):
+        self.snapshot = snapshot
+        self.sql = sql
+        self.params = params
+        self.decode = decode
+
+    async def __aiter__(self):
+        cursor = await self.snapshot.run(lambda db: db.execute(self.sql, self.params))
+        while rows := await self.snapshot.run(lambda db: cursor.fetchmany(cursor_batch_size)):
+            for row in rows:
+                yield self.decode(row)
+
+    async def close(self):
+        pass
+
+def transaction(db, function, *args):
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        result = function(db, *args)
+    except:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+    return result
+
+def write_update(db, object, actor):
+    changes = Counter()
+    reply = put_object(db, object, actor, changes)
+    count_contexts(db, actor, changes)
+    return reply
+
+def write_update_many(db, objects, actor):
+    changes = Counter()
+    replies = [ { "reply": put_object(db, object, actor, changes) } for object in objects ]
+    count_contexts(db, actor, changes)
+    return replies
+
+def write_remove(db, object_id, actor):
+    changes = Counter()
+    reply = delete_object(db, object_id, changes)
+    count_contexts(db, actor, changes)
+    return reply
+
+def write_remove_many(db, object_ids, actor):
+    changes = Counter()
+    replies = []
+    for object_id in object_ids:
+        reply = delete_object(db, object_id, changes)
+        replies.append({ "reply": reply } if reply else { "error": missing_error })
+    count_contexts(db, actor, changes)
+    return replies
+
+def put_object(db, object, actor, changes):
+    # Identical copies are left alone
+    object_hash = content_hash(object)
+    row = db.execute(find_object, (object["id"],)).fetchone()
+    if row and row[1] == object_hash:
+        return "replaced"
+
+    seq = next_sequence(db)
+    db.execute('INSERT OR REPLACE INTO objects (id, actor, data, hash, seq) VALUES (?, ?, ?, ?, ?)',
+        (object["id"], actor, dumps(object), object_hash, seq))
+    db.execute('DELETE FROM access WHERE id = ?', (object["id"],))
+    db.executemany('INSERT OR IGNORE INTO access (pair, id) VALUES (?, ?)',
+        [ (pair, object["id"]) for pair in access_fields(object)["_access"] ])
+
+    old_object = loads(row[0]) if row else None
+    if old_object:
+        # If anyone might have lost sight of the object,
+        # leave a tombstone for incremental subscribers
+        if lost_access(old_object, object):
+            add_tombstone(db, old_object, seq)
+        context_changes(object["context"], old_object["context"], changes)
+    else:
+        context_changes(object["context"], [], changes)
+
+    add_change(db, object | { "_seq": seq }, old_object)
+    return "replaced" if old_object else "inserted"
+
+def delete_object(db, object_id, changes):
+    row = db.execute(find_object, (object_id,)).fetchone()
+    if not row: return None
+
+    old_object = loads(row[0])
+    seq = next_sequence(db)
+    db.execute('DELETE FROM objects WHERE id = ?', (object_id,))
+    db.execute('DELETE FROM access WHERE id = ?', (object_id,))
+    add_tombstone(db, old_object, seq)
+    context_changes([], old_object["context"], changes)
+
+    add_change(db, None, old_object)
+    return "removed"
+
+def add_tombstone(db, old_object, seq):
+    db.execute('INSERT INTO tombstones (seq, id, actor, context, removed) VALUES (?, ?, ?, ?, ?)',
+        (seq, old_object["id"], old_object["actor"], dumps(old_object["context"]), time.time()))
+    db.executemany('INSERT OR IGNORE INTO tombstone_access (pair, seq) VALUES (?, ?)',
+        [ (pair, seq) for pair in access_fields(old_object)["_access"] ])
+
+def add_change(db, new, old):
+    db.execute('INSERT INTO changes (time, new, old) VALUES (?, ?, ?)', (
+        time.time(),
+        None if new is None else dumps(new),
+        None if old is None else dumps(old)))
+
+def count_contexts(db, actor, changes):
+    # Keep track of how many objects each
+    # actor has in each of their contexts
+    changes = { context: n for context, n in changes.items() if n }
+    if not changes: return
+
+    db.executemany('''INSERT INTO contexts (actor, context, count) VALUES (?, ?, ?)
+        ON CONFLICT (actor, context) DO UPDATE SET count = count + excluded.count''',
+        [ (actor, context, n) for context, n in changes.items() ])
+    if any(n < 0 for n in changes.values()):
+        db.execute('DELETE FROM contexts WHERE actor = ? AND count <= 0', (actor,))
+
+def next_sequence(db):
+    db.execute('''INSERT INTO counters (name, value) VALUES ('seq', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1''')
+    return counter_value(db, "seq")
+
+def counter_value(db, name):
+    row = db.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+def write_purge(db):
+    # Forget tombstones that are older than the retention
+    # window and raise the horizon past them, so that
+    # "since" values from before it are rejected
+    horizon, = db.execute('SELECT max(seq) FROM tombstones WHERE removed < ?',
+        (time.time() - tombstone_retention,)).fetchone()
+    if horizon is not None:
+        db.execute('''INSERT INTO counters (name, value) VALUES ('horizon', ?)
+            ON CONFLICT (name) DO UPDATE SET value = max(value, excluded.value)''', (horizon,))
+        db.execute('DELETE FROM tombstone_access WHERE seq <= ?', (horizon,))
+        db.execute('DELETE FROM tombstones WHERE seq <= ?', (horizon,))
+
+    db.execute('DELETE FROM changes WHERE time < ?', (time.time() - change_retention,))
+
+def latest_change(db):
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+def changes_after(db, id_):
+    return db.execute('SELECT id, time, new, old FROM changes WHERE id > ? ORDER BY id LIMIT ?',
+        (id_, cursor_batch_size)).fetchall()
+
+def explain(db, sql, params):
+    # The steps of the query plan
+    return '; '.join(row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+def begin_snapshot(db):
+    db.execute('BEGIN')
+    return latest_change(db)
+
+def end_snapshot(db):
+    if db.in_transaction:
+        db.execute('ROLLBACK')
+    db.close()
@@ -0,0 +1,38 @@
+from os import getenv
+
+# Where objects are stored. "mongo" needs a MongoDB replica
+# set, "sqlite" keeps everything in a local file for
+# single-machine deployments.
+backend = getenv('STORAGE', 'mongo')
+
+# Every backend provides:
+#
+#   setup()                        create tables/indexes, migrate
+#   update(object, actor)          -> "inserted" | "replaced"
+#   update_many(objects, actor)    -> [{"reply"|"error": ...}]
+#   remove(object_id, actor)       -> "removed", or raises
+#   remove_many(object_ids, actor) -> [{"reply"|"error": ...}]
+#   contexts(actor)                -> contexts the actor has objects in
+#   sequence_value(name="seq")     -> current "seq" or "horizon"
+#   purge()                        forget expired tombstones
+#   changes()                      endless async iterator of changes
+#   resume_token                   position of the last change
+#   snapshot()                     async context manager with
+#     .sequence_value()            last "seq" in the snapshot
+#     .objects(actor, contexts, since=None)
+#     .tombstones(actor, contexts, since)
+#     .time                        change feed time of the snapshot
+#
+# Checks on who may write what happen before the backend
+# is called. Sequence values must be committed in order.
+# Changes look like MongoDB change events with "_id",
+# "clusterTime", "fullDocument" (minus on removal) and
+# "fullDocumentBeforeChange" (minus on insertion).
+
+def create_storage():
+    if backend == 'sqlite':
+        from .sqlite import SQLiteStorage
+        return SQLiteStorage()
+    else:
+        from .mongo import MongoStorage
+        return MongoStorage()
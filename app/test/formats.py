@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import cbor2
+import msgpack
+import asyncio
+import datetime
+from decimal import Decimal
+from utils import *
+
+formats = {
+    'graffiti.msgpack': (msgpack.packb, msgpack.unpackb),
+    'graffiti.cbor': (cbor2.dumps, cbor2.loads)
+}
+
+# Values each format can carry that JSON can't
+non_json = {
+    'graffiti.msgpack': [b'bytes', msgpack.ExtType(1, b'ext')],
+    'graffiti.cbor': [b'bytes', datetime.datetime.now(datetime.timezone.utc), Decimal('1.5'), {1, 2}]
+}
+
+async def main():
+
+    my_id, my_token = actor_id_and_token()
+
+    print("Not asking for a format gets JSON")
+    async with websocket_connect(my_token) as ws:
+        assert ws.subprotocol is None
+        await send(ws, { 'messageID': random_id(), 'ls': None })
+        result = await recv(ws)
+        assert 'reply' in result
+
+    print("Asking for an unknown format gets JSON")
+    async with websocket_connect(my_token, ['graffiti.xml', 'graffiti.json']) as ws:
+        assert ws.subprotocol == 'graffiti.json'
+
+    for name, (dumps, loads) in formats.items():
+        context = random_id()
+
+        print(f"Asking for {name}")
+        async with websocket_connect(my_token, [name]) as ws:
+            assert ws.subprotocol == name
+            send_frame = lambda msg: ws.send(dumps(msg))
+            async def recv_frame():
+                frame = await ws.recv()
+                assert isinstance(frame, bytes)
+                return loads(frame)
+
+            print("Writing objects")
+            for i in range(3):
+                await send_frame({
+                    'messageID': random_id(),
+                    'update': object_base(my_id) | {
+                        'context': [context],
+                        'number': i,
+                        'nested': { 'list': [1.5, None, True, "ünïcödé"] }
+                    }
+                })
+                result = await recv_frame()
+                assert result['reply'] == 'inserted', result
+
+            print("Receiving them in a batch")
+            await send_frame({ 'messageID': random_id(), 'subscribe': [context], 'batch': True, 'since': 0 })
+            result = await recv_frame()
+            assert result['reply'] == 'subscribed'
+            result = await recv_frame()
+            assert result['historical']
+            assert sorted(obj['number'] for obj in result['updates']) == [0, 1, 2]
+            assert result['updates'][0]['nested'] == { 'list': [1.5, None, True, "ünïcödé"] }
+            assert result['seq'] > 0
+            result = await recv_frame()
+            assert result['replayed'] == [context]
+
+            print("Receiving live changes")
+            await send_frame({
+                'messageID': random_id(),
+                'update': object_base(my_id) | { 'context': [context], 'number': 3 }
+            })
+            results = [ await recv_frame(), await recv_frame() ]
+            update = next(r for r in results if 'update' in r)
+            assert update['update']['number'] == 3
+            assert not update['historical']
+
+            print("Sending a malformed message")
+            await send_frame({ 'messageID': random_id(), 'nonsense': True })
+            result = await recv_frame()
+            assert result['error'] == 'validation'
+
+            print("Sending values JSON doesn't have")
+            for value in non_json[name]:
+                await send_frame({
+                    'messageID': random_id(),
+                    'update': object_base(my_id) | { 'context': [context], 'value': value }
+                })
+                result = await recv_frame()
+                assert result['error'] == 'validation', result
+            await send_frame({ 'messageID': random_id(), 'ls': None })
+            result = await recv_frame()
+            assert 'reply' in result
+
+if __name__ == "__main__":
+    asyncio.run(main())
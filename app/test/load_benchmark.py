@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Opens many sockets against a running server, subscribes them
+# to contexts of varying popularity and drives writes through
+# it. Results are printed as JSON so runs can be compared:
+#
+#   app/test/load_benchmark.py --sockets 5000 --output before.json
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import websockets
+from utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test a running graffiti app.")
+    parser.add_argument('--sockets', type=int, default=1000, help="authenticated subscribers")
+    parser.add_argument('--anonymous', type=int, default=1000, help="anonymous subscribers")
+    parser.add_argument('--contexts', type=int, default=100, help="distinct contexts")
+    parser.add_argument('--subscriptions', type=int, default=3, help="contexts per subscriber")
+    parser.add_argument('--skew', type=float, default=1.0, help="zipf exponent of context popularity")
+    parser.add_argument('--preload', type=int, default=1000, help="objects written before subscribing")
+    parser.add_argument('--batch', action='store_true', help="subscribe with batched replay")
+    parser.add_argument('--writers', type=int, default=10, help="sockets that write")
+    parser.add_argument('--rate', type=float, default=100, help="writes per second")
+    parser.add_argument('--replace', type=float, default=0.2, help="fraction of writes that replace")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of writing")
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="sockets opened at once")
+    parser.add_argument('--pid', type=int, help="server process, found automatically if omitted")
+    parser.add_argument('--output', help="file for the results instead of stdout")
+    return parser.parse_args()
+
+class Stats:
+
+    def __init__(self):
+        self.historical = 0
+        self.delivered = []
+        self.acks = []
+
+class Client:
+    # A socket that matches replies to requests
+    # and records whatever else it receives
+
+    def __init__(self, ws, stats):
+        self.ws = ws
+        self.stats = stats
+        self.replies = {} # messageID -> future
+        self.replayed = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        try:
+            async for message in self.ws:
+                self.receive(json.loads(message))
+        except websockets.ConnectionClosed:
+            pass
+
+    def receive(self, msg):
+        now = time.time()
+        if msg.get('messageID') in self.replies:
+            self.replies.pop(msg['messageID']).set_result(msg)
+        elif 'replayed' in msg:
+            if not self.replayed.done():
+                self.replayed.set_result(now)
+        elif msg.get('historical'):
+            self.stats.historical += len(msg['updates']) if 'updates' in msg else 1
+        elif 'update' in msg and 'sentAt' in msg['update']:
+            self.stats.delivered.append(now - msg['update']['sentAt'])
+
+    async def request(self, msg):
+        msg['messageID'] = random_id()
+        reply = asyncio.get_running_loop().create_future()
+        self.replies[msg['messageID']] = reply
+        await send(self.ws, msg)
+        return await reply
+
+    async def close(self):
+        await self.ws.close()
+        await self.task
+
+class Contexts:
+    # Contexts whose popularity follows a zipf distribution
+
+    def __init__(self, count, skew):
+        self.names = [ random_id() for i in range(count) ]
+        self.weights = [ 1/(rank+1)**skew for rank in range(count) ]
+        self.subscribers = { name: 0 for name in self.names }
+
+    def sample(self, k=1):
+        chosen = set()
+        while len(chosen) < min(k, len(self.names)):
+            chosen.add(random.choices(self.names, self.weights)[0])
+        return list(chosen)
+
+def percentiles(values):
+    if not values: return { "count": 0 }
+    values = sorted(values)
+    pick = lambda p: values[min(len(values)-1, int(p*len(values)))]
+    return {
+        "count": len(values),
+        "mean": sum(values)/len(values),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": values[-1]
+    }
+
+def server_pids(pid=None):
+    # The server and all of its worker processes
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            if pid is None:
+                with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                    if b'app.main' in f.read() and int(entry) != os.getpid():
+                        pid = int(entry)
+        except OSError:
+            pass
+    if pid is None: return []
+    pids = [pid]
+    for pid in pids:
+        pids += [ child for child, parent in parents.items() if parent == pid ]
+    return pids
+
+def server_rss(pid=None):
+    # Resident memory of the server in bytes
+    total = 0
+    pids = server_pids(pid)
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total if pids else None
+
+async def connect(count, token_for, stats, concurrency):
+    limit = asyncio.Semaphore(concurrency)
+    async def open_one(i):
+        async with limit:
+            ws = await websocket_connect(token_for(i))
+            return Client(ws, stats)
+    return await asyncio.gather(*[ open_one(i) for i in range(count) ])
+
+async def preload(writer, actor_id, contexts, count):
+    for start in range(0, count, 100):
+        reply = await writer.request({
+            'updateMany': [
+                object_base(actor_id) | { 'context': contexts.sample() }
+                for i in range(min(100, count - start))
+            ]
+        })
+        assert all('reply' in r for r in reply['reply']), reply
+
+async def subscribe(clients, contexts, k, batch):
+    async def subscribe_one(client):
+        chosen = contexts.sample(k)
+        for context in chosen:
+            contexts.subscribers[context] += 1
+        msg = { 'subscribe': chosen, 'since': 0 }
+        if batch: msg['batch'] = True
+        reply = await client.request(msg)
+        assert reply.get('reply') == 'subscribed', reply
+        await client.replayed
+    await asyncio.gather(*[ subscribe_one(client) for client in clients ])
+
+async def write(writers, contexts, stats, args):
+    expected = 0
+    owned = [ [] for writer in writers ]
+    interval = len(writers) / args.rate
+    end = time.monotonic() + args.duration
+
+    async def write_one(i, writer, actor_id):
+        nonlocal expected
+        if owned[i] and random.random() < args.replace:
+            obj = random.choice(owned[i])
+        else:
+            obj = object_base(actor_id)
+            owned[i].append(obj)
+        obj |= { 'context': contexts.sample(), 'sentAt': time.time() }
+        expected += contexts.subscribers[obj['context'][0]]
+        start = time.monotonic()
+        reply = await writer.request({ 'update': obj })
+        if 'reply' in reply:
+            stats.acks.append(time.monotonic() - start)
+
+    async def write_loop(i, writer, actor_id):
+        # Stagger the writers and jitter the
+        # interval so writes don't arrive in lockstep
+        await asyncio.sleep(random.random() * interval)
+        tasks = set()
+        while time.monotonic() < end:
+            task = asyncio.create_task(write_one(i, writer, actor_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await asyncio.sleep(random.expovariate(1/interval))
+        if tasks:
+            await asyncio.wait(tasks)
+
+    await asyncio.gather(*[ write_loop(i, writer, actor_id) for i, (writer, actor_id) in enumerate(writers) ])
+    return expected, sum(len(o) for o in owned)
+
+async def sample_rss(pid, peak):
+    while True:
+        rss = server_rss(pid)
+        if rss: peak[0] = max(peak[0], rss)
+        await asyncio.sleep(1)
+
+async def main():
+    args = parse_args()
+
+    # Each socket needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    stats = Stats()
+    contexts = Contexts(args.contexts, args.skew)
+    results = { "config": vars(args), "rss": { "idle": server_rss(args.pid) } }
+    log = lambda *a: print(*a, file=sys.stderr)
+
+    log(f"opening {args.writers} writers")
+    writer_ids = [ actor_id_and_token() for i in range(args.writers) ]
+    writer_sockets = await connect(args.writers, lambda i: writer_ids[i][1], stats, args.connect_concurrency)
+    writers = [ (writer, actor_id) for writer, (actor_id, token) in zip(writer_sockets, writer_ids) ]
+
+    log(f"preloading {args.preload} objects")
+    start = time.monotonic()
+    await preload(writers[0][0], writers[0][1], contexts, args.preload)
+    results["preload"] = { "objects": args.preload, "seconds": time.monotonic() - start }
+
+    total = args.sockets + args.anonymous
+    log(f"opening {args.sockets} authenticated and {args.anonymous} anonymous sockets")
+    start = time.monotonic()
+    subscribers = await connect(total,
+        lambda i: actor_id_and_token()[1] if i < args.sockets else None,
+        stats, args.connect_concurrency)
+    seconds = time.monotonic() - start
+    results["connect"] = { "sockets": total, "seconds": seconds, "per_second": total/seconds }
+    results["rss"]["connected"] = server_rss(args.pid)
+
+    log(f"subscribing to {args.subscriptions} of {args.contexts} contexts each")
+    start = time.monotonic()
+    await subscribe(subscribers, contexts, args.subscriptions, args.batch)
+    seconds = time.monotonic() - start
+    results["backfill"] = {
+        "subscriptions": len(subscribers),
+        "objects": stats.historical,
+        "seconds": seconds,
+        "objects_per_second": stats.historical/seconds
+    }
+    results["rss"]["subscribed"] = server_rss(args.pid)
+
+    log(f"writing {args.rate} objects per second for {args.duration} seconds")
+    peak = [0]
+    sampler = asyncio.create_task(sample_rss(args.pid, peak))
+    start = time.monotonic()
+    expected, objects = await write(writers, contexts, stats, args)
+    seconds = time.monotonic() - start
+
+    # Let the last changes arrive
+    await asyncio.sleep(2)
+    sampler.cancel()
+    results["writes"] = {
+        "count": len(stats.acks),
+        "objects": objects,
+        "per_second": len(stats.acks)/seconds,
+        "ack_latency": percentiles(stats.acks)
+    }
+    results["delivery"] = {
+        "expected": expected,
+        "latency": percentiles(stats.delivered)
+    }
+    results["rss"]["peak"] = peak[0] or None
+    results["rss"]["end"] = server_rss(args.pid)
+
+    log("closing sockets")
+    await asyncio.gather(*[ client.close() for client in writer_sockets + subscribers ])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import asyncio
+from utils import *
+
+def apply(obj, operations):
+    # Enough of JSON Patch for what the server sends
+    for operation in operations:
+        *parents, key = [ part.replace('~1', '/').replace('~0', '~')
+            for part in operation['path'].split('/')[1:] ]
+        target = obj
+        for parent in parents:
+            target = target[parent]
+        if operation['op'] == 'remove':
+            del target[key]
+        else:
+            target[key] = operation['value']
+    return obj
+
+async def recv_live(ws):
+    result = { 'historical': True }
+    while result.get('historical') or 'reply' in result:
+        result = await recv(ws)
+    return result
+
+async def main():
+
+    my_id, my_token = actor_id_and_token()
+    other_id, other_token = actor_id_and_token()
+    context = random_id()
+
+    async with websocket_connect(my_token) as ws:
+        async with websocket_connect(other_token) as other:
+            async with websocket_connect(other_token) as plain:
+
+                print("Subscribing with and without patches")
+                await send(other, { 'messageID': random_id(), 'subscribe': [context], 'patch': True })
+                result = await recv(other)
+                assert result['reply'] == 'subscribed'
+                await send(plain, { 'messageID': random_id(), 'subscribe': [context] })
+                result = await recv(plain)
+                assert result['reply'] == 'subscribed'
+                await asyncio.sleep(0.5)
+
+                print("Creating an object sends it whole")
+                obj = object_base(my_id) | {
+                    'context': [context],
+                    'content': 'x'*1000,
+                    'nested': { 'title': 'old', 'a/b': 1, 'tags': ['a'] }
+                }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert result['update'] == obj
+                copy = result['update']
+                result = await recv_live(plain)
+                assert result['update'] == obj
+
+                print("Replacing it sends a patch")
+                obj = obj | { 'nested': { 'title': 'new', 'a/b': 2, 'tags': ['a', 'b'] }, 'extra': True }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert 'patch' in result, result
+                assert result['patch']['id'] == obj['id']
+                assert 'x'*1000 not in str(result)
+                assert result['seq'] > 0
+                copy = apply(copy, result['patch']['operations'])
+                assert copy == obj
+                print("...and the patched copy matches")
+
+                print("Sockets that didn't ask still get the whole object")
+                result = await recv_live(plain)
+                assert result['update'] == obj
+
+                print("Removing a field")
+                del obj['extra']
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                copy = apply(copy, result['patch']['operations'])
+                assert copy == obj
+                result = await recv_live(plain)
+
+                print("Subscribing to a quiet context doesn't stop patches")
+                await send(other, { 'messageID': random_id(), 'subscribe': [random_id()] })
+                await asyncio.sleep(0.5)
+                obj = obj | { 'content': 'z'*1000 }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert 'patch' in result, result
+                copy = apply(copy, result['patch']['operations'])
+                assert copy == obj
+                await recv_live(plain)
+
+                print("Subscribing to the object without patches gets it whole")
+                await send(other, { 'messageID': random_id(), 'subscribe': [obj['id']] })
+                await asyncio.sleep(0.5)
+                obj = obj | { 'content': 'w'*1000 }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert result['update'] == obj
+                copy = result['update']
+                await recv_live(plain)
+
+                print("...until it unsubscribes")
+                await send(other, { 'messageID': random_id(), 'unsubscribe': [obj['id']] })
+                await asyncio.sleep(0.5)
+                obj = obj | { 'content': 'v'*1000 }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert 'patch' in result, result
+                copy = apply(copy, result['patch']['operations'])
+                assert copy == obj
+                await recv_live(plain)
+
+                print("Patches still go out while an unrelated backfill is running")
+                big = random_id()
+                for _ in range(40):
+                    message_id = random_id()
+                    await send(ws, { 'messageID': message_id, 'updateMany': [
+                        object_base(my_id) | { 'context': [big], 'content': random_id(5000) }
+                        for _ in range(100) ] })
+                    result = await recv(ws)
+                    while result.get('messageID') != message_id:
+                        result = await recv(ws)
+                    assert 'reply' in result, result
+                # Not reading from the socket stalls the backfill
+                await send(other, { 'messageID': random_id(), 'subscribe': [big], 'since': 0 })
+                await asyncio.sleep(0.5)
+                obj = obj | { 'content': 'u'*1000 }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await asyncio.wait_for(recv_live(plain), 10)
+                assert result['update'] == obj
+                patched = False
+                while True:
+                    result = await recv(other)
+                    if 'replayed' in result: break
+                    if 'patch' in result:
+                        copy = apply(copy, result['patch']['operations'])
+                        patched = True
+                assert patched, "the patch should arrive before the backfill ends"
+                assert copy == obj
+                await send(other, { 'messageID': random_id(), 'unsubscribe': [big] })
+                await asyncio.sleep(0.5)
+                print("...as expected")
+
+                print("Sockets that couldn't see the old version get it whole")
+                obj = obj | { 'bto': [f"graffitiactor://{other_id}"] }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert 'patch' in result
+                copy = apply(copy, result['patch']['operations'])
+                assert copy == obj
+                await recv_live(plain)
+                obj = obj | { 'bto': [] }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert 'remove' in result
+                obj = obj | { 'bto': [f"graffitiactor://{other_id}"], 'content': 'y' }
+                await send(ws, { 'messageID': random_id(), 'update': obj })
+                result = await recv_live(other)
+                assert result['update'] == obj
+                print("...as expected")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -196,5 +196,57 @@ async def main():
         assert not await another_message(ws, recv=recv_historical)
         print("Snoop cannot see it")
 
+    async with websocket_connect(my_token) as ws:
+
+        print("querying for the 10 objects in batches")
+        await send(ws, {
+            'messageID': random_id(),
+            'subscribe': [custom_context],
+            'batch': True
+        })
+        result = await recv_historical(ws)
+        assert result['reply'] == 'subscribed'
+        result = await recv_historical(ws)
+        assert result['historical']
+        assert len(result['updates']) == 10
+        for obj in result['updates']:
+            assert obj['context'] == [custom_context]
+        assert not await another_message(ws, recv=recv_historical)
+        print("...received in one frame")
+
+    async with websocket_connect(my_token) as ws:
+        async with websocket_connect(my_token) as reader:
+
+            print("adding a large context and a small one")
+            big, small = random_id(), random_id()
+            for i in range(40):
+                message_id = random_id()
+                await send(ws, { 'messageID': message_id, 'updateMany': [
+                    object_base(my_id) | { 'context': [big], 'content': random_id(5000) }
+                    for _ in range(100) ] + ([
+                    object_base(my_id) | { 'context': [small] }
+                    for _ in range(5) ] if i == 39 else []) })
+                result = await recv(ws)
+                while result.get('messageID') != message_id:
+                    result = await recv(ws)
+                assert 'reply' in result, result
+            print("...added")
+
+            print("unsubscribing from one while they are sent")
+            # Not reading from the socket stalls the backfill
+            await send(reader, { 'messageID': random_id(), 'subscribe': [big, small], 'since': 0 })
+            await asyncio.sleep(0.5)
+            await send(reader, { 'messageID': random_id(), 'unsubscribe': [big] })
+            counts = { big: 0, small: 0 }
+            while True:
+                result = await recv(reader)
+                if 'replayed' in result: break
+                if 'update' in result:
+                    counts[result['update']['context'][0]] += 1
+            assert result['replayed'] == [small]
+            assert counts[small] == 5
+            assert counts[big] < 4000, counts
+            print(f"...stopped after {counts[big]} of 4000")
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -42,6 +42,19 @@ async def main():
         assert result['update']['hello'] == 'world'
         print("...received")
 
+        print("Saving it again unchanged")
+        await send(ws, {
+            'messageID': random_id(),
+            'update': base | {
+                'hello': 'world',
+                'context': [custom_context]
+            }
+        })
+        result = await recv(ws)
+        assert result['reply'] == 'replaced'
+        assert not await another_message(ws)
+        print("...nothing was sent")
+
         print("Replacing it")
         await send(ws, {
             'messageID': random_id(),
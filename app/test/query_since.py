@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import asyncio
+from utils import *
+
+async def recv_replay(ws):
+    # Collect historical messages until the replay is done
+    updates, removes = {}, {}
+    result = {}
+    while 'replayed' not in result:
+        result = await recv(ws)
+        if result.get('historical'):
+            if 'update' in result:
+                updates[result['update']['id']] = result['update']
+            if 'remove' in result:
+                removes[result['remove']['id']] = result['remove']
+    return updates, removes, result['seq']
+
+async def subscribe_since(token, context, since):
+    async with websocket_connect(token) as ws:
+        await send(ws, {
+            'messageID': random_id(),
+            'subscribe': [context],
+            'since': since
+        })
+        result = await recv(ws)
+        assert result['reply'] == 'subscribed'
+        return await recv_replay(ws)
+
+async def main():
+
+    custom_context = random_id()
+    other_context = random_id()
+
+    my_id, my_token = actor_id_and_token()
+    async with websocket_connect(my_token) as ws:
+        print("adding 3 objects")
+        bases = [ object_base(my_id) for i in range(3) ]
+        for base in bases:
+            await send(ws, {
+                'messageID': random_id(),
+                'update': base | {
+                    'context': [custom_context]
+                }
+            })
+            result = await recv(ws)
+            assert result['reply'] == 'inserted'
+        print("...added")
+
+    print("subscribing since the beginning")
+    updates, removes, seq = await subscribe_since(my_token, custom_context, 0)
+    assert len(updates) == 3
+    assert not removes
+    print("...got all of them")
+
+    print("subscribing since the watermark")
+    updates, removes, seq2 = await subscribe_since(my_token, custom_context, seq)
+    assert not updates
+    assert not removes
+    assert seq2 >= seq
+    print("...got nothing new")
+
+    async with websocket_connect(my_token) as ws:
+        print("adding, removing and moving objects")
+        new_base = object_base(my_id)
+        await send(ws, {
+            'messageID': random_id(),
+            'update': new_base | {
+                'context': [custom_context]
+            }
+        })
+        result = await recv(ws)
+        assert result['reply'] == 'inserted'
+        await send(ws, {
+            'messageID': random_id(),
+            'remove': bases[0]['id']
+        })
+        result = await recv(ws)
+        assert result['reply'] == 'removed'
+        await send(ws, {
+            'messageID': random_id(),
+            'update': bases[1] | {
+                'context': [other_context]
+            }
+        })
+        result = await recv(ws)
+        assert result['reply'] == 'replaced'
+        print("...done")
+
+    print("subscribing since the watermark")
+    updates, removes, seq3 = await subscribe_since(my_token, custom_context, seq)
+    assert list(updates) == [new_base['id']]
+    assert set(removes) == { bases[0]['id'], bases[1]['id'] }
+    assert seq3 > seq
+    print("...got only the changes")
+
+    print("subscribing since the new watermark")
+    updates, removes, seq4 = await subscribe_since(my_token, custom_context, seq3)
+    assert not updates
+    assert not removes
+    print("...got nothing new")
+
+if __name__ == "__main__":
+    asyncio.run(main())
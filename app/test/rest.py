@@ -244,5 +244,74 @@ async def main():
         assert 'hello' in result["reply"]
         print("The user has only one context")
 
+    # Create a new user for batches
+    my_actor_id, my_token = actor_id_and_token()
+    async with websocket_connect(my_token) as ws:
+        bases = [ object_base(my_actor_id) for i in range(100) ]
+        print("Adding 100 objects at once")
+        await send(ws, {
+            'messageID': random_id(),
+            'updateMany': [ base | { 'context': ['batch'] } for base in bases ]
+        })
+        result = await recv(ws)
+        assert result['reply'] == [ { 'reply': 'inserted' } ] * 100
+        print("...Added")
+
+        print("Replacing half of them, plus one by someone else")
+        other = object_base(random_sha())
+        await send(ws, {
+            'messageID': random_id(),
+            'updateMany': [ base | { 'context': ['other'] } for base in bases[:50] ] + [ other ]
+        })
+        result = await recv(ws)
+        assert result['reply'][:50] == [ { 'reply': 'replaced' } ] * 50
+        assert 'error' in result['reply'][50]
+        print("...Replaced the right ones")
+
+        await send(ws, { 'messageID': random_id(), "ls": None })
+        result = await recv(ws)
+        assert set(result["reply"]) == { 'batch', 'other' }
+        print("The user has both contexts")
+
+        print("Removing all of them, plus one twice")
+        await send(ws, {
+            'messageID': random_id(),
+            'removeMany': [ base['id'] for base in bases ] + [ bases[0]['id'] ]
+        })
+        result = await recv(ws)
+        assert result['reply'][:100] == [ { 'reply': 'removed' } ] * 100
+        assert 'error' in result['reply'][100]
+        print("...Removed them")
+
+        await send(ws, {
+            'messageID': random_id(),
+            'removeMany': [ bases[0]['id'] ]
+        })
+        result = await recv(ws)
+        assert 'error' in result['reply'][0]
+        print("Could not re-remove object (as expected)")
+
+        await send(ws, { 'messageID': random_id(), "ls": None })
+        result = await recv(ws)
+        assert len(result["reply"]) == 0
+        print("The user has no contexts")
+
+    async with websocket_connect(my_token) as ws:
+        print("Sending 50 writes to one object without waiting")
+        base = object_base(my_actor_id)
+        message_ids = [ random_id() for i in range(50) ]
+        for i, message_id in enumerate(message_ids):
+            await send(ws, {
+                'messageID': message_id,
+                'update': base | { 'count': i }
+            })
+        replies = {}
+        for message_id in message_ids:
+            result = await recv(ws)
+            replies[result['messageID']] = result['reply']
+        assert replies[message_ids[0]] == 'inserted'
+        assert all(replies[message_id] == 'replaced' for message_id in message_ids[1:])
+        print("...They were applied in order")
+
 if __name__ == "__main__":
     asyncio.run(main())
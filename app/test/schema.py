@@ -37,6 +37,13 @@ def valid_requests(my_actor):
     # remove
     "messageID": "a"*64,
     "remove": base_object['id']
+}, {
+    # batches
+    "messageID": random_id(),
+    "updateMany": [base_object, object_base(my_actor)]
+}, {
+    "messageID": random_id(),
+    "removeMany": [base_object['id']]
 }, {
     # subscribe
     "messageID": "iueiruwoeiurowiwf1293  -e 👍",
@@ -44,6 +51,18 @@ def valid_requests(my_actor):
 }, {
     "messageID": random_id(),
     "subscribe": ["goodbye", "hello"]
+}, {
+    "messageID": random_id(),
+    "subscribe": ["batched"],
+    "batch": True
+}, {
+    "messageID": random_id(),
+    "subscribe": ["incremental"],
+    "since": 0
+}, {
+    "messageID": random_id(),
+    "subscribe": ["patched"],
+    "patch": True
 }, {
     # unsubscribe
     "messageID": random_id(),
@@ -157,6 +176,7 @@ def valid_requests(my_actor):
 def invalid_requests(my_actor):
     base_object = object_base(my_actor)
     return [{}, # Empty
+5, None, "update", [], # Not objects
 {
     # no message ID
     "update": base_object,
@@ -170,6 +190,24 @@ def invalid_requests(my_actor):
     "messageID": random_id(),
     "update": base_object,
     "ls": None
+}, {
+    # Empty batches
+    "messageID": random_id(),
+    "updateMany": []
+}, {
+    "messageID": random_id(),
+    "removeMany": []
+}, {
+    # Batches of the wrong thing
+    "messageID": random_id(),
+    "updateMany": [base_object['id']]
+}, {
+    "messageID": random_id(),
+    "removeMany": [base_object]
+}, {
+    # Too many at once
+    "messageID": random_id(),
+    "removeMany": [base_object['id']]*1001
 }, {
     # id should be an string
     "messageID": random_id(),
@@ -324,6 +362,40 @@ def invalid_requests(my_actor):
     # LS is anything but none
     "messageID": random_id(),
     "ls": 1
+}, {
+    # Batch is not a boolean
+    "messageID": random_id(),
+    "subscribe": ["asdf"],
+    "batch": 1
+}, {
+    # Batch without a subscription
+    "messageID": random_id(),
+    "update": base_object,
+    "batch": True
+}, {
+    # Since is not a non-negative integer
+    "messageID": random_id(),
+    "subscribe": ["asdf"],
+    "since": -1
+}, {
+    "messageID": random_id(),
+    "subscribe": ["asdf"],
+    "since": "1"
+}, {
+    # Since without a subscription
+    "messageID": random_id(),
+    "unsubscribe": ["asdf"],
+    "since": 0
+}, {
+    # Patch is not a boolean
+    "messageID": random_id(),
+    "subscribe": ["asdf"],
+    "patch": "yes"
+}, {
+    # Patch without a subscription
+    "messageID": random_id(),
+    "ls": None,
+    "patch": True
 }]
 
 if __name__ == "__main__":
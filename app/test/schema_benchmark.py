@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import sys
+import timeit
+from pathlib import Path
+from utils import *
+
+# Import the app from the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from app.schema import schema, validate
+from jsonschema import Draft7Validator
+
+def messages(my_actor):
+    base = object_base(my_actor)
+    return {
+        "update": {
+            "messageID": random_id(),
+            "update": base | {
+                "bto": [random_actor(), random_actor()],
+                "content": "hello world",
+                "tags": ["a", "b", "c"]
+            }
+        },
+        "remove": {
+            "messageID": random_id(),
+            "remove": base['id']
+        },
+        "subscribe": {
+            "messageID": random_id(),
+            "subscribe": [random_id() for i in range(5)],
+            "since": 1234
+        },
+        "updateMany": {
+            "messageID": random_id(),
+            "updateMany": [ object_base(my_actor) for i in range(100) ]
+        },
+        "invalid": {
+            "messageID": random_id(),
+            "update": base | { "bto": ["12345"] }
+        }
+    }
+
+def jsonschema_validate():
+    validator = Draft7Validator(schema, format_checker=Draft7Validator.FORMAT_CHECKER)
+    return validator.validate
+
+def rate(validate, msg, number):
+    def run():
+        try:
+            validate(msg)
+        except:
+            pass
+    return number / min(timeit.repeat(run, number=number, repeat=5))
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    old = jsonschema_validate()
+
+    print(f"{'message':<12}{'jsonschema/s':>15}{'compiled/s':>15}{'speedup':>10}")
+    for name, msg in messages(random_sha()).items():
+        old_rate = rate(old, msg, number)
+        new_rate = rate(validate, msg, number)
+        print(f"{name:<12}{old_rate:>15.0f}{new_rate:>15.0f}{new_rate/old_rate:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -39,11 +39,11 @@ def actor_id_and_token():
         }, secret, algorithm="HS256")
     return id_, token
 
-def websocket_connect(token=None):
+def websocket_connect(token=None, subprotocols=None):
     link = "ws://localhost:8000"
     if token:
         link += f"?token={token}"
-    return websockets.connect(link)
+    return websockets.connect(link, subprotocols=subprotocols)
 
 async def send(ws, j):
     await ws.send(json.dumps(j))
@@ -0,0 +1,93 @@
+import time
+import asyncio
+import logging
+from os import getenv
+from contextvars import ContextVar
+from contextlib import contextmanager, nullcontext
+
+# Requests, changes and backfills that take longer than
+# this are logged along with where the time went and how
+# the database ran their queries. Off unless set.
+slow = getenv('TRACE_SLOW')
+threshold = float(slow) if slow else None # sec
+
+logger = logging.getLogger('uvicorn.error')
+
+# The trace of whatever the current task is doing
+current = ContextVar('trace', default=None)
+
+class Trace:
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.spans = {} # name -> sec, in the order they started
+        self.queries = [] # (name, async function returning a plan summary)
+        self.finished = False
+
+    def add(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0) + duration
+
+def begin(name, start=None):
+    # Start tracing the current task, if tracing is on.
+    # If it started earlier, it was waiting in a queue.
+    if threshold is None: return None
+    now = time.perf_counter()
+    trace = Trace(name, now if start is None else start)
+    if start is not None:
+        trace.add('queue', now - start)
+    current.set(trace)
+    return trace
+
+def span(name):
+    trace = current.get()
+    if trace is None or trace.finished:
+        return nullcontext()
+    return timed(trace, name)
+
+@contextmanager
+def timed(trace, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+def query(name, explain):
+    # Remember how to explain a query in case the trace is slow.
+    # Explaining is only done after the fact, in the background.
+    trace = current.get()
+    if trace is not None and not trace.finished:
+        trace.queries.append((name, explain))
+
+def end(trace, detail=None):
+    if trace is None: return
+    trace.finished = True
+    current.set(None)
+
+    total = time.perf_counter() - trace.start
+    if total < threshold: return
+
+    spans = ', '.join(f"{name} {sec:.3f}s" for name, sec in trace.spans.items())
+    other = total - sum(trace.spans.values())
+    message = f"slow {trace.name} took {total:.3f}s: {spans}{', ' if spans else ''}other {other:.3f}s"
+    if detail: message += f" ({detail})"
+
+    if not trace.queries:
+        logger.warning(message)
+        return
+    task = asyncio.create_task(log_with_plans(message, trace.queries))
+    explaining.add(task)
+    task.add_done_callback(explaining.discard)
+
+# Keep references to the explanations in progress
+explaining = set()
+
+async def log_with_plans(message, queries):
+    for name, explain in queries:
+        try:
+            plan = await explain()
+        except Exception as e:
+            plan = f"could not explain: {e}"
+        message += f"\n    {name}: {plan}"
+    logger.warning(message)
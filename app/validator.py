@@ -0,0 +1,203 @@
+import re
+
+# Compiles a JSON schema into nested checking functions
+# ahead of time, so that validating a message doesn't
+# re-walk the schema. Only the keywords the message
+# schema uses are supported. The compiled check is only
+# a fast path: whenever it fails, the message is checked
+# again with jsonschema, which produces the error. So
+# anything it can't decide just costs time.
+
+def compile_validator(schema):
+    check = Compiler(schema).compile(schema)
+    validator = None
+
+    def validate(instance):
+        nonlocal validator
+        if check(instance): return
+        # jsonschema is slow to import so only load
+        # it once there is an error to describe
+        if validator is None:
+            from jsonschema import Draft7Validator
+            validator = Draft7Validator(schema, format_checker=Draft7Validator.FORMAT_CHECKER)
+        validator.validate(instance)
+
+    return validate
+
+def reject(instance):
+    return False
+
+class Compiler:
+
+    def __init__(self, root):
+        self.root = root
+        self.refs = {} # ref -> check
+
+    def compile(self, schema):
+        # Other keywords are ignored next to a reference
+        if '$ref' in schema:
+            return self.ref(schema['$ref'])
+
+        checks = []
+        for keyword, value in schema.items():
+            if keyword not in keywords:
+                return reject
+            check = keywords[keyword](self, value, schema)
+            if check is not None:
+                checks.append(check)
+
+        if not checks:
+            return lambda instance: True
+        if len(checks) == 1:
+            return checks[0]
+        checks = tuple(checks)
+        return lambda instance: all(check(instance) for check in checks)
+
+    def ref(self, ref):
+        if not ref.startswith('#/'):
+            return reject
+        if ref not in self.refs:
+            # Mark the reference first in case
+            # the definition refers to itself
+            self.refs[ref] = None
+            target = self.root
+            for part in ref[2:].split('/'):
+                target = target[part]
+            self.refs[ref] = self.compile(target)
+        return self.refs[ref] or (lambda instance: self.refs[ref](instance))
+
+def is_integer(instance):
+    if isinstance(instance, bool): return False
+    if isinstance(instance, int): return True
+    return isinstance(instance, float) and instance.is_integer()
+
+def is_number(instance):
+    return isinstance(instance, (int, float)) and not isinstance(instance, bool)
+
+types = {
+    "object": lambda instance: isinstance(instance, dict),
+    "array": lambda instance: isinstance(instance, list),
+    "string": lambda instance: isinstance(instance, str),
+    "boolean": lambda instance: isinstance(instance, bool),
+    "null": lambda instance: instance is None,
+    "integer": is_integer,
+    "number": is_number
+}
+
+def compile_type(compiler, value, schema):
+    if isinstance(value, list):
+        if not all(t in types for t in value): return reject
+        checks = tuple(types[t] for t in value)
+        return lambda instance: any(check(instance) for check in checks)
+    return types.get(value, reject)
+
+def compile_properties(compiler, value, schema):
+    checks = tuple((key, compiler.compile(subschema)) for key, subschema in value.items())
+    def check(instance):
+        if not isinstance(instance, dict): return True
+        for key, check_value in checks:
+            if key in instance and not check_value(instance[key]):
+                return False
+        return True
+    return check
+
+def compile_additional_properties(compiler, value, schema):
+    if 'patternProperties' in schema: return reject
+    allowed = frozenset(schema.get('properties', {}))
+    if value is False:
+        return lambda instance: not isinstance(instance, dict) or instance.keys() <= allowed
+    if value is True:
+        return None
+    extra = compiler.compile(value)
+    def check(instance):
+        if not isinstance(instance, dict): return True
+        return all(extra(v) for k, v in instance.items() if k not in allowed)
+    return check
+
+def compile_required(compiler, value, schema):
+    required = tuple(value)
+    return lambda instance: not isinstance(instance, dict) or all(key in instance for key in required)
+
+def compile_dependencies(compiler, value, schema):
+    checks = []
+    for key, dependency in value.items():
+        if isinstance(dependency, list):
+            dependency = { "required": dependency }
+        checks.append((key, compiler.compile(dependency)))
+    def check(instance):
+        if not isinstance(instance, dict): return True
+        return all(check_dependency(instance) for key, check_dependency in checks if key in instance)
+    return check
+
+def compile_one_of(compiler, value, schema):
+    checks = tuple(compiler.compile(subschema) for subschema in value)
+    return lambda instance: sum(1 for check in checks if check(instance)) == 1
+
+def compile_pattern(compiler, value, schema):
+    search = re.compile(value).search
+    return lambda instance: not isinstance(instance, str) or search(instance) is not None
+
+def compile_format(compiler, value, schema):
+    conforms = None
+    def check(instance):
+        nonlocal conforms
+        if not isinstance(instance, str): return True
+        # Format checkers are loaded on first use
+        if conforms is None:
+            conforms = load_format(value)
+        return conforms(instance)
+    return check
+
+def compile_items(compiler, value, schema):
+    if isinstance(value, list): return reject
+    item = compiler.compile(value)
+    return lambda instance: not isinstance(instance, list) or all(item(i) for i in instance)
+
+def compile_min_items(compiler, value, schema):
+    return lambda instance: not isinstance(instance, list) or len(instance) >= value
+
+def compile_max_items(compiler, value, schema):
+    return lambda instance: not isinstance(instance, list) or len(instance) <= value
+
+def compile_unique_items(compiler, value, schema):
+    if not value: return None
+    def check(instance):
+        if not isinstance(instance, list): return True
+        # Strings are the common case, anything
+        # else is left to jsonschema
+        if not all(isinstance(i, str) for i in instance): return False
+        return len(set(instance)) == len(instance)
+    return check
+
+def compile_minimum(compiler, value, schema):
+    return lambda instance: not is_number(instance) or instance >= value
+
+def ignore(compiler, value, schema):
+    return None
+
+keywords = {
+    "type": compile_type,
+    "properties": compile_properties,
+    "additionalProperties": compile_additional_properties,
+    "required": compile_required,
+    "dependencies": compile_dependencies,
+    "oneOf": compile_one_of,
+    "pattern": compile_pattern,
+    "format": compile_format,
+    "items": compile_items,
+    "minItems": compile_min_items,
+    "maxItems": compile_max_items,
+    "uniqueItems": compile_unique_items,
+    "minimum": compile_minimum,
+    "definitions": ignore
+}
+
+def load_format(name):
+    if name == "date-time":
+        # jsonschema skips the check without this
+        try:
+            from rfc3339_validator import validate_rfc3339
+        except ImportError:
+            return lambda instance: True
+        return lambda instance: validate_rfc3339(instance.upper())
+    return reject
@@ -0,0 +1,162 @@
+import time
+import heapq
+import asyncio
+from os import getenv
+from datetime import datetime, timezone
+
+# Where magic links are kept until they are clicked or expire.
+# "memory" only works with a single process, "mongo" shares
+# them between processes through a TTL collection.
+backend = getenv('MAGIC_STORE', 'memory')
+
+class MemoryStore:
+
+    def __init__(self):
+        self.links = {} # hash -> [signature, expires, event, status]
+        self.expiry = [] # heap of (expires, hash)
+
+    async def add(self, signature_hash, signature, expires):
+        self.expire()
+        self.links[signature_hash] = [signature, expires, asyncio.Event(), None]
+        heapq.heappush(self.expiry, (expires, signature_hash))
+
+    async def get(self, signature_hash):
+        # Returns the signature if the link is live
+        link = self.links.get(signature_hash)
+        if link and link[1] > time.time():
+            return link[0]
+
+    async def confirm(self, signature_hash):
+        return await self.finish(signature_hash, 'confirmed')
+
+    async def fail(self, signature_hash):
+        return await self.finish(signature_hash, 'failed')
+
+    async def finish(self, signature_hash, status):
+        if not await self.get(signature_hash):
+            return False
+        link = self.links[signature_hash]
+        link[3] = status
+        link[2].set()
+        return True
+
+    async def wait(self, signature_hash, timeout):
+        # Returns "confirmed" if the link was clicked,
+        # "failed" if the email couldn't be sent, or
+        # None if neither happened in time
+        link = self.links.get(signature_hash)
+        if not link: return None
+        try:
+            await asyncio.wait_for(link[2].wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return link[3]
+
+    def expire(self):
+        now = time.time()
+        while self.expiry and self.expiry[0][0] < now:
+            expires, signature_hash = heapq.heappop(self.expiry)
+            link = self.links.get(signature_hash)
+            if link and link[1] == expires:
+                del self.links[signature_hash]
+
+class MongoStore:
+    # Links are documents that MongoDB deletes once they
+    # expire. Clicks and failed emails are broadcast to every
+    # process over a change stream, so the click and the waiting socket
+    # can be served by different workers.
+
+    def __init__(self):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        self.links = AsyncIOMotorClient('mongo').auth.magic
+        self.waiters = {} # hash -> set(event)
+        self.ready = False
+        self.watch_task = None
+
+    async def setup(self):
+        if not self.ready:
+            await self.links.create_index('expires', expireAfterSeconds=0)
+            self.ready = True
+        if not self.watch_task:
+            self.watch_task = asyncio.create_task(self.watch())
+
+    async def add(self, signature_hash, signature, expires):
+        await self.setup()
+        await self.links.insert_one({
+            "_id": signature_hash,
+            "signature": signature,
+            "expires": datetime.fromtimestamp(expires, timezone.utc),
+            "status": None
+        })
+
+    def live(self, signature_hash):
+        # The TTL monitor only runs every
+        # minute so check the time too
+        return {
+            "_id": signature_hash,
+            "expires": { "$gt": datetime.now(timezone.utc) }
+        }
+
+    async def get(self, signature_hash):
+        link = await self.links.find_one(self.live(signature_hash))
+        if link:
+            return link["signature"]
+
+    async def confirm(self, signature_hash):
+        return await self.finish(signature_hash, 'confirmed')
+
+    async def fail(self, signature_hash):
+        return await self.finish(signature_hash, 'failed')
+
+    async def finish(self, signature_hash, status):
+        await self.setup()
+        result = await self.links.update_one(
+            self.live(signature_hash),
+            { "$set": { "status": status } })
+        return result.matched_count > 0
+
+    async def wait(self, signature_hash, timeout):
+        await self.setup()
+        event = asyncio.Event()
+        self.waiters.setdefault(signature_hash, set()).add(event)
+        try:
+            # Check after listening so a click
+            # in between isn't missed
+            link = await self.links.find_one(self.live(signature_hash))
+            if not link: return None
+            if link.get("status"): return link["status"]
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return event.status
+        finally:
+            self.waiters[signature_hash].discard(event)
+            if not self.waiters[signature_hash]:
+                del self.waiters[signature_hash]
+
+    async def watch(self):
+        while True:
+            try:
+                async with self.links.watch([{ "$match": {
+                    "operationType": "update",
+                    "updateDescription.updatedFields.status": { "$ne": None }
+                }}]) as stream:
+                    async for change in stream:
+                        for event in self.waiters.get(change["documentKey"]["_id"], ()):
+                            event.status = change["updateDescription"]["updatedFields"]["status"]
+                            event.set()
+            except asyncio.CancelledError:
+                raise
+            except:
+                # Waiters still time out and recheck
+                # the database until this comes back
+                await asyncio.sleep(1)
+
+stores = {
+    'memory': MemoryStore,
+    'mongo': MongoStore
+}
+
+def create_store():
+    return stores[backend]()
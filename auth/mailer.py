@@ -0,0 +1,59 @@
+import asyncio
+from os import getenv
+from aiosmtplib import SMTP
+
+# Emails are sent in the background over a few
+# connections to the mail server that stay open
+pool_size = int(getenv('MAIL_POOL_SIZE', 2))
+queue_size = int(getenv('MAIL_QUEUE_SIZE', 1000))
+retries = int(getenv('MAIL_RETRIES', 4))
+min_backoff = 0.5 # sec
+max_backoff = 30  # sec
+
+class Mailer:
+
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.queue = asyncio.Queue(queue_size)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [ asyncio.create_task(self.work()) for i in range(pool_size) ]
+
+    def send(self, message, on_failure):
+        # Returns false if too many emails are waiting
+        try:
+            self.queue.put_nowait((message, on_failure))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def work(self):
+        smtp = None
+        while True:
+            message, on_failure = await self.queue.get()
+
+            backoff = min_backoff
+            for attempt in range(retries):
+                try:
+                    if not smtp or not smtp.is_connected:
+                        smtp = SMTP(hostname=self.hostname, port=self.port, start_tls=False)
+                        await smtp.connect()
+                    await smtp.send_message(message)
+                    break
+                except:
+                    # The server may have dropped an idle
+                    # connection, so reconnect and try again
+                    if smtp:
+                        smtp.close()
+                        smtp = None
+                    await asyncio.sleep(backoff)
+                    backoff = min(max_backoff, 2*backoff)
+            else:
+                try:
+                    await on_failure()
+                except:
+                    pass
+
+            self.queue.task_done()
@@ -2,10 +2,8 @@
 
 import time
 import jwt
-import asyncio
 from hashlib import sha256
 from os import getenv
-from aiosmtplib import send as sendEmail
 from email.message import EmailMessage
 from email.utils import formatdate, make_msgid
 from uuid import uuid5, NAMESPACE_DNS
@@ -18,11 +16,19 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 
+from .magic import create_store
+from .mailer import Mailer
+
 debug = (getenv('DEBUG') == 'true')
 url_divider = ('' if debug else 's') + '://'
 expiration_time = 60*float(getenv('AUTH_CODE_EXP_TIME')) # min -> sec
 domain = getenv('DOMAIN')
 secret = getenv('AUTH_SECRET')
+keepalive = float(getenv('AUTH_KEEPALIVE', 10)) # sec
+
+# More than one worker needs MAGIC_STORE=mongo so
+# that magic links are shared between them
+workers = int(getenv('WORKERS', 1))
 
 app = FastAPI()
 
@@ -40,7 +46,12 @@ app.mount("/style", StaticFiles(directory="auth/style"), name="style")
 templates = Jinja2Templates(directory="auth/templates")
 
 # For magic linking
-magic_events = {} # hash -> (event, signature, time)
+magic_links = create_store()
+mailer = Mailer("mailserver", 25)
+
+@app.on_event("startup")
+async def startup():
+    mailer.start()
 
 @app.get("/", response_class=HTMLResponse)
 async def auth(
@@ -49,7 +60,8 @@ async def auth(
         request: Request,
         state: str|None = "",
         email: str|None = "",
-        expired: bool|None = ""):
+        expired: bool|None = "",
+        undelivered: bool|None = ""):
 
     # Ask the user to log in
     return templates.TemplateResponse("login.html", {
@@ -60,7 +72,8 @@ async def auth(
         'redirect_uri': redirect_uri,
         'state': state,
         'email': email,
-        'expired': expired
+        'expired': expired,
+        'undelivered': undelivered
     })
 
 @app.get("/email", response_class=HTMLResponse)
@@ -105,33 +118,25 @@ async def email(
     message["Message-ID"] = make_msgid()
     message["Date"] = formatdate()
 
+    # Wait for the link to be clicked
+    signature_hash = sha256(signature.encode()).hexdigest()
+    await magic_links.add(signature_hash, signature, time.time() + expiration_time)
+
     if debug:
         print(message)
         print(f"LINK> {login_link}")
 
-    else:
-        # Send!
-        try:
-            await sendEmail(message, hostname="mailserver", port=25, start_tls=False)
-        except:
-            # Redirect back home with an error
-            home = "/?" + urlencode({
-                'client_id': client_id,
-                'redirect_uri': redirect_uri,
-                'state': state,
-                'email': email
-            })
-            return f"<script>window.location.replace('{home}')</script>"
-
-    # Create an event
-    now = time.time()
-    signature_hash = sha256(signature.encode()).hexdigest()
-    magic_events[signature_hash] = (asyncio.Event(), signature, now)
-
-    # Remove expired events
-    expired_hashes = [h for h in magic_events if magic_events[h][2] + expiration_time < now]
-    for h in expired_hashes:
-        del magic_events[h]
+    # Send in the background, and tell the
+    # waiting page if it doesn't go through
+    elif not mailer.send(message, lambda: magic_links.fail(signature_hash)):
+        # Redirect back home with an error
+        home = "/?" + urlencode({
+            'client_id': client_id,
+            'redirect_uri': redirect_uri,
+            'state': state,
+            'email': email
+        })
+        return f"<script>window.location.replace('{home}')</script>"
 
     # Return a form that will combine the code pieces
     # and then send it to the redirect_uri
@@ -185,33 +190,29 @@ def token(
 async def auth_socket(ws: WebSocket, signature_hash: str):
     await ws.accept()
 
-    if signature_hash not in magic_events:
-        await ws.send_json({'type': 'error'})
-        await ws.close()
-        return
-
-    event, signature, t = magic_events[signature_hash]
-    while t + expiration_time > time.time():
-        # Wait for the event
-        try:
-            await asyncio.wait_for(event.wait(), 1)
-        except asyncio.TimeoutError:
-            # Send a boop to keep alive
-            try:
-                await ws.send_json({'type': 'boop'})
-            except:
-                break
-        else:
-            # Send the signature and cleanup
+    while await magic_links.get(signature_hash):
+        # Wait for the link to be clicked
+        status = await magic_links.wait(signature_hash, keepalive)
+        if status == 'confirmed':
+            # Send the signature
             await ws.send_json({
                 'type': 'signature',
-                'signature': signature
+                'signature': await magic_links.get(signature_hash)
             })
             await ws.close()
             break
+        elif status == 'failed':
+            # The email never went out
+            await ws.send_json({'type': 'error', 'detail': 'undelivered'})
+            await ws.close()
+            break
+        else:
+            # Send a boop to keep alive
+            try:
+                await ws.send_json({'type': 'boop'})
+            except:
+                break
     else:
-        if signature_hash in magic_events:
-            del magic_events[signature_hash]
         await ws.send_json({'type': 'error'})
         await ws.close()
 
@@ -221,23 +222,13 @@ async def auth_socket_send(signature: str, request: Request):
     # Take the hash of the signature, to make sure it's real
     signature_hash = sha256(signature.encode()).hexdigest()
 
-    if signature_hash not in magic_events:
-        return templates.TemplateResponse("close.html", {
-            'request': request,
-            'error': "link expired"
-        })
-
-    event, signature, t = magic_events[signature_hash]
-    if t + expiration_time < time.time():
-        del magic_events[signature_hash]
+    # Wake up whoever is waiting for it
+    if not await magic_links.confirm(signature_hash):
         return templates.TemplateResponse("close.html", {
             'request': request,
             'error': "link expired"
         })
 
-    # Set the event
-    event.set()
-
     # Close
     return templates.TemplateResponse("close.html", {
         'request': request,
@@ -248,4 +239,6 @@ if __name__ == "__main__":
     args = {}
     if getenv('DEBUG') == 'true':
         args['reload'] = True
+    else:
+        args['workers'] = workers
     uvicorn.run('auth.main:app', host='0.0.0.0', **args)